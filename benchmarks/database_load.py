@@ -0,0 +1,85 @@
+# OOOZet - Bot społeczności OOOZ
+# Copyright (C) 2023-2026 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares how long it takes to decode synthetic databases with the schema-aware
+# decoder in database.py and with the object_hook it replaced. Run it from the
+# main folder with `python3 -m benchmarks.database_load [<user count>…]`.
+
+import json, random, sys, time
+from datetime import datetime, timedelta
+
+import database
+from features import budzik, counting, xp # For their schemas
+
+def object_hook(object): # The decoder from before database.decode_section.
+  if set(object) == {'__set__'}:
+    return set(object['__set__'])
+  elif set(object) == {'__datetime__'}:
+    return datetime.fromisoformat(object['__datetime__'])
+  else:
+    def maybe_int(x):
+      try:
+        return int(x)
+      except ValueError:
+        return x
+    return {maybe_int(k): v for k, v in object.items()}
+
+def generate(userc):
+  random.seed(userc)
+  users = random.sample(range(10**17, 10**18), userc)
+  now = datetime.now().astimezone()
+  return {
+    'xp': {i: random.randint(0, 10**6) for i in users},
+    'xp_last_gain': {i: now - timedelta(seconds=random.randint(0, 10**8)) for i in users},
+    'counting_score': {i: random.randint(1, 1000) for i in users[: userc // 10]},
+    'warns': {
+      i: [{'time': now - timedelta(days=random.randint(0, 1000)), 'reason': 'spam', 'expired': None} for _ in range(random.randint(1, 3))]
+      for i in users[: userc // 100]
+    },
+    'budzik_first_pings': {
+      (now - timedelta(days=day)).date().isoformat(): {i: now - timedelta(days=day) for i in users[: min(userc // 100, 50)]}
+      for day in range(90)
+    },
+    'sugestie_clean_until': now,
+  }
+
+def measure(func):
+  best = None
+  for _ in range(3):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+    if elapsed > 5:
+      break
+  return best, result
+
+def main():
+  userc_list = [int(i) for i in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+  print(f'Using {"orjson" if database.orjson is not None else "json"} for parsing')
+  for userc in userc_list:
+    data = generate(userc)
+    whole = json.dumps(data, cls=database.Encoder)
+    sections = {k: json.dumps(v, cls=database.Encoder) for k, v in data.items()}
+
+    old_time, old_result = measure(lambda: json.loads(whole, object_hook=object_hook))
+    new_time, new_result = measure(lambda: {k: database.decode_section(k, database.loads(v)) for k, v in sections.items()})
+    assert old_result == new_result == data
+
+    print(f'{userc:>9} users, {len(whole) / 2**20:7.1f} MiB: object_hook {old_time:7.3f}s, decode_section {new_time:7.3f}s ({old_time / new_time:.1f}x)')
+
+if __name__ == '__main__':
+  main()
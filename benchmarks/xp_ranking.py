@@ -0,0 +1,67 @@
+# OOOZet - Bot społeczności OOOZ
+# Copyright (C) 2023-2026 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares how long it takes to render the /xp show page of a user with the
+# rank index in database.py and with the sort it replaced. Run it from the main
+# folder with `python3 -m benchmarks.xp_ranking [<user count>…]`.
+
+import random, sys, time
+
+import database
+
+def old_show(xp, user): # The lookup from before database.rank_of.
+  ranking = sorted(xp.items(), key=lambda x: x[1], reverse=True)
+  rank = next(i for i, entry in enumerate(ranking) if entry[0] == user)
+  return ranking[rank // 20 * 20:(rank // 20 + 1) * 20]
+
+def new_show(user):
+  rank = database.rank_of('xp', user)
+  return database.ranking('xp', rank // 20 * 20, (rank // 20 + 1) * 20)
+
+def gain(user):
+  database.data['xp'][user] += random.randint(15, 25)
+  database.touch('xp', user)
+
+def measure(func, users):
+  start = time.perf_counter()
+  for user in users:
+    func(user)
+  return (time.perf_counter() - start) / len(users)
+
+def main():
+  userc_list = [int(i) for i in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+  for userc in userc_list:
+    random.seed(userc)
+    users = random.sample(range(10**17, 10**18), userc)
+    database.data = database.Data()
+    database.data['xp'] = {i: random.randint(0, 10**6) for i in users}
+    database.rank_indexes.clear()
+    queries = random.choices(users, k=20)
+
+    start = time.perf_counter()
+    database.rank_of('xp', users[0])
+    build_time = time.perf_counter() - start
+
+    old_time = measure(lambda user: old_show(database.data['xp'], user), queries)
+    new_time = measure(new_show, queries)
+    gain_time = measure(gain, random.choices(users, k=10_000))
+    for user in queries:
+      assert [i[1] for i in old_show(database.data['xp'], user)] == [i[1] for i in new_show(user)]
+
+    print(f'{userc:>9} users: sort {old_time * 1000:8.3f}ms, index {new_time * 1000:8.3f}ms ({old_time / new_time:.0f}x) per page, {gain_time * 10**6:.1f}µs per XP gain, {build_time:.3f}s to build the index')
+
+if __name__ == '__main__':
+  main()
@@ -29,7 +29,11 @@ options = {
 config = {
   'token': None,                             # Token twojego bota
   'database': 'database.json',               # Ścieżka do pliku z baza danych
+  'database_backend': 'json',                # Sposób przechowywania bazy danych: "json" albo "sqlite" (plik <database>.sqlite, do którego przy pierwszym uruchomieniu zostanie zaimportowana baza JSON)
   'autosave': '1m',                          # Regularny odstęp czasu, w którym baza danych będzie automatycznie zapisywana, gdy jest to potrzebne
+  'backup_days': 7,                          # Liczba ostatnich dni, z których trzymana jest najnowsza codzienna kopia zapasowa bazy danych
+  'backup_weeks': 4,                         # To samo dla tygodni
+  'backup_months': 12,                       # To samo dla miesięcy
   'console_host': 'localhost',               # Te dwa są w zasadzie oczywiste
   'console_port': 2341,
   'console_hello': 'OOOZet',                 # Nazwa wyświetlana w "… says hello!" po połączeniu się z konsolą
@@ -39,6 +43,9 @@ config = {
   'staff_roles': [],                         # Role, których członkowie należą do administracji
   'server_maintainer': None,                 # ID osoby odpowiedzialnej za logi bota
   'timezone': 'Europe/Warsaw',               # Strefa czasowa IANA, w której żyje społeczność
+  'bulk_delete_delay': '1s',                 # Czas, przez który zbierane są wiadomości do usunięcia, zanim zostaną usunięte jednym zapytaniem
+  'user_cache_ttl': '1h',                    # Czas, przez który pamiętane są dane użytkowników spoza serwera pobrane z API
+  'user_cache_size': 1000,                   # Maksymalna liczba pamiętanych użytkowników spoza serwera
 
   'alarm_cooldown': '5m',                    # Cooldown dla komendy /alarm
   'timeout_role': None,                      # Rola kosmetyczna pokazująca, czy użytkownik ma timeouta
@@ -47,15 +54,19 @@ config = {
 
   'warn_expire_interval': { 'months': 3 },   # Obiekt relativedelta określający odstęp czasu od ostatniej zmianie w liczbie warnów użytkownika, po którym wygasa najstarszy warn
   'counting_channel': None,                  # Kanał "#liczenie"
+  'counting_recalc_ranges': 32,              # Liczba kawałków, na które dzielona jest historia #liczenie przy przeliczaniu rankingu przez counting.recalc w konsoli
+  'counting_recalc_workers': 4,              # Liczba kawałków historii #liczenie pobieranych jednocześnie
   'fajne_zadanka_channel': None,             # Kanał, na który użytkownicy mogą wysyłać linki do zadań algorytmicznych
 
   'xp_cooldown': '1m',                       # Odstęp czasu, po którym można ponownie dostać XP
+  'xp_flush_rate': '5s',                     # Częstotliwość przyznawania XP za wiadomości zebrane od ostatniego razu
   'xp_min_gain': 15,                         # Minimalna ilość XP, którą można dostać za jedną wiadomość
   'xp_max_gain': 40,                         # Maksymalna ilość XP, którą można dostać za jedną wiadomość
   'xp_ignored_channels': [],                 # Kanały, które nie są liczone do XP
   'xp_ignored_categories': [],               # Kategorie kanałów, które nie są liczone do XP
   'xp_unignored_channels': [],               # Wyjątki do powyższego
   'xp_roles': [],                            # Role, które można dostać za poziomy, format to [<poziom>, <rola>]
+  'xp_role_workers': 4,                      # Maksymalna liczba członków serwera, którym jednocześnie aktualizowane są role za XP przez xp.update_roles w konsoli
   'xp_channel': None,                        # Kanał na ogłoszenia o kolejnych poziomach zdobywanych przez użytkowników
 
   'sugestie_channel': None,                  # Kanał "#sugestie"
@@ -64,6 +75,7 @@ config = {
   'sugestie_review_length': '1d',            # Czas na opiniowanie sugestii
   'sugestie_vote_ping_role': None,           # Rola, która jest pingowana, gdy zaczyna się głosowanie nad sugestią
   'sugestie_vote_length': '1d',              # Czas na głosowanie nad sugestią
+  'sugestie_edit_delay': '2s',               # Czas, przez który zbierane są głosy na sugestię, zanim jej wiadomość zostanie zaktualizowana
 
   'websub_host': None,                       # Adres tego serwera
   'websub_port': 13579,                      # Port, na którym będzie odpalony serwer WebSub
@@ -104,6 +116,7 @@ config = {
   'help_forum_eval_max_age': '1y',           # Maksymalny wiek postów branych pod uwagę w rankingu pomagaczy
   'help_forum_contrib_cooldown': '1m',       # Odstęp czasu, po którym można ponownie dostać punkt udziału w rozwiązywaniu pytania
   'help_forum_eval_rate': '1d',              # Częstotliwość aktualizowania rankingu pomagaczy
+  'help_forum_rescan_workers': 4,            # Liczba postów na forum pomocy czytanych jednocześnie przez help_forum.rescan w konsoli
 
   'budzik_channel': None,                    # Kanał, na którym użytkownicy pingują poniższe role o odpowiednich godzinach
   'budzik_roles': [],                        # Lista trójek [rola, godzina, minuta] dla ról, których pingowalność jest zarządzana przez bota
@@ -205,7 +218,9 @@ def mention_message(client, channel, msg):
 def debacktick(string):
   return string.replace('`', '')
 
-def pages_view(init_page, pagec, on_select_page, owner):
+def pages_view(init_page, pagec, on_select_page, owner, *, contents_of=None):
+  # Given contents_of, pages are rendered only once they get selected and
+  # on_select_page can be None.
   view = discord.ui.View()
   async def interaction_check(interaction):
     return interaction.user == owner
@@ -219,7 +234,11 @@ def pages_view(init_page, pagec, on_select_page, owner):
     nonlocal curr_page
     curr_page = page
     refresh()
-    await on_select_page(interaction, curr_page)
+    if contents_of is not None:
+      await interaction.response.defer()
+      await interaction.edit_original_response(content=contents_of(curr_page), view=view)
+    if on_select_page is not None:
+      await on_select_page(interaction, curr_page)
 
   first = discord.ui.Button(label='⇤')
   async def callback(interaction):
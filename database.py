@@ -14,65 +14,895 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import json, logging, os, shutil, threading
+import gzip, json, logging, os, shutil, sqlite3, sys, threading, time
+from collections.abc import MutableMapping
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
+from hashlib import sha256
 
 import console
 from common import config, parse_duration
 
+try:
+  import orjson # Parses JSON several times faster than the standard library.
+except ImportError:
+  orjson = None
+try:
+  import zstandard # Compresses backups better and faster than gzip.
+except ImportError:
+  zstandard = None
+
 data = None
-should_save = False
+should_save = False # Forces a rewrite of all segments, see touch() for a cheaper alternative.
+dirty = {} # Paths passed to touch() in the order they were first touched, as keys
+unsaved_sections = set() # Sections with changes in the journal that their segments don't have yet
+segment_sizes = {}
+connection = None # Only used by the SQLite backend
+rank_indexes = {} # Built on first use by ranking() and rank_of() and kept up to date by touch()
 lock = threading.RLock()
+save_lock = threading.Lock() # Held for a whole save, while lock is held only until the data is captured
+
+def maybe_int(x):
+  try:
+    return int(x)
+  except ValueError:
+    return x
+
+def key_of(string):
+  # Same as maybe_int but without raising an exception for the usual keys.
+  if string.isdecimal():
+    return int(string)
+  elif string[:1].isalpha():
+    return string
+  else:
+    return maybe_int(string)
+
+def convert(value):
+  # Turns plain JSON into what we keep in memory: {'__set__': …} into a set,
+  # {'__datetime__': …} into a datetime and keys that are numbers into ints.
+  if isinstance(value, dict):
+    if len(value) == 1:
+      if '__set__' in value:
+        return set(value['__set__'])
+      elif '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return {key_of(k): convert(v) if isinstance(v, dict | list) else v for k, v in value.items()}
+  elif isinstance(value, list):
+    return [convert(i) if isinstance(i, dict | list) else i for i in value]
+  else:
+    return value
+
+# Converting a big section with convert() still means a few Python function calls
+# for every value in it. Features can instead describe what their sections look
+# like here and have them converted in a single comprehension.
+schemas = {}
+
+def as_datetime(value):
+  return datetime.fromisoformat(value['__datetime__'])
+
+def keyed_by_int(convert_value=None):
+  if convert_value is None:
+    return lambda section: {int(k): v for k, v in section.items()}
+  else:
+    return lambda section: {int(k): convert_value(v) for k, v in section.items()}
+
+def keyed_by_str(convert_value):
+  return lambda section: {k: convert_value(v) for k, v in section.items()}
+
+def loads(string):
+  return orjson.loads(string) if orjson is not None else json.loads(string)
+
+def decode_section(section, value):
+  if section in schemas:
+    try:
+      return schemas[section](value)
+    except (AttributeError, KeyError, TypeError, ValueError):
+      logging.warn(f'Section {section!r} does not match its schema')
+  return convert(value)
+
+class Encoder(json.JSONEncoder):
+  def default(self, value):
+    if isinstance(value, set):
+      return {'__set__': list(value)}
+    elif isinstance(value, datetime):
+      return {'__datetime__': value.isoformat()}
+    else:
+      return super().default(value)
+
+def touch(*path):
+  # Marks data[path[0]][path[1]]… as changed or deleted, so that the next save
+  # appends only this one value to the journal instead of rewriting everything.
+  # Paths may go through lists too, but then only by an index that stays valid
+  # until the next save. Appending and touching the new index is fine too.
+  dirty.setdefault(path)
+  if path[0] in rank_indexes:
+    with lock:
+      if len(path) == 1:
+        rank_indexes.pop(path[0], None)
+      elif path[0] in rank_indexes:
+        rank_indexes[path[0]].update(path[1], data[path[0]].get(path[1]))
+
+class Data(dict):
+  # Assigning or deleting a whole section is tracked automatically. With the
+  # SQLite backend, sections which are dicts also get moved into their own
+  # tables.
+  def __setitem__(self, key, value):
+    if connection is not None:
+      if isinstance(self.get(key), Table) and value is not self[key]:
+        self[key].drop()
+      if isinstance(value, dict):
+        value = Table.create(key, value)
+    super().__setitem__(key, value)
+    touch(key)
+
+  def __delitem__(self, key):
+    if isinstance(self[key], Table):
+      self[key].drop()
+    super().__delitem__(key)
+    touch(key)
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self[key] = default
+    return self[key]
+
+  def pop(self, key, *args):
+    if key in self:
+      value = self[key]
+      del self[key]
+      return value
+    return super().pop(key, *args)
+
+  def update(self, *args, **kwargs):
+    for key, value in dict(*args, **kwargs).items():
+      self[key] = value
+
+def encode(value):
+  # Numbers are kept as they are, so that SQLite can sort and index them.
+  return value if isinstance(value, int | float) and not isinstance(value, bool) else json.dumps(value, cls=Encoder)
+
+def decode(value):
+  return convert(loads(value)) if isinstance(value, str) else value
+
+def refcount_of(container, key):
+  return sys.getrefcount(container[key])
+
+unshared_refcount = refcount_of([[]], 0) # Just the container and the argument of getrefcount
+
+def is_shared(container, key):
+  # Whether anything besides the container refers to container[key] or to any
+  # value inside of it, in which case it may still get changed in place.
+  if refcount_of(container, key) > unshared_refcount:
+    return True
+  value = container[key]
+  keys = value.keys() if isinstance(value, dict) else range(len(value)) if isinstance(value, list) else []
+  return any(isinstance(value[i], dict | list | set) and is_shared(value, i) for i in keys)
+
+def begin():
+  # The sqlite3 module starts transactions only for changes to rows, so without
+  # this, creating or dropping a table would be committed right away, before
+  # the matching change to the sections table.
+  if not connection.in_transaction:
+    connection.execute('BEGIN')
+
+class Table(MutableMapping):
+  # A section stored in its own SQLite table. Assignments and deletions are
+  # written through to the current transaction, which gets committed on save.
+  # Values that can be changed in place are cached, so that the object someone
+  # changed and touched is the one that gets written back on save and so that
+  # reading a value twice gives the same object. Everything else is read from
+  # the table on every access. After a save, the cached values that nothing
+  # else refers to anymore get dropped, so memory doesn't grow with the size of
+  # the table.
+  def __init__(self, section):
+    assert isinstance(section, str) and '"' not in section
+    self.section = section
+    self.name = f'"section:{section}"'
+    self.cache = {}
+    self.dropped = set() # Keys dropped from the cache and not read since
+
+  @staticmethod
+  def create(section, contents):
+    with lock:
+      begin()
+      table = Table(section)
+      connection.execute(f'CREATE TABLE IF NOT EXISTS {table.name} (key PRIMARY KEY, value)')
+      connection.execute(f'CREATE INDEX IF NOT EXISTS "section:{section}:value" ON {table.name} (value DESC, key)')
+      connection.execute(f'DELETE FROM {table.name}')
+      connection.executemany(f'INSERT INTO {table.name} (key, value) VALUES (?, ?)', ((k, encode(v)) for k, v in contents.items()))
+      connection.execute('INSERT OR REPLACE INTO sections (name, is_table, value) VALUES (?, 1, NULL)', (section,))
+      for key, value in contents.items():
+        table.remember(key, value)
+      return table
+
+  def drop(self):
+    with lock:
+      begin()
+      connection.execute(f'DROP TABLE IF EXISTS {self.name}')
+      connection.execute('DELETE FROM sections WHERE name = ?', (self.section,))
+      self.cache.clear()
+      self.dropped.clear()
+
+  def remember(self, key, value):
+    self.dropped.discard(key)
+    if isinstance(value, dict | list | set):
+      self.cache[key] = value
+    else:
+      self.cache.pop(key, None)
+    return value
+
+  def __getitem__(self, key):
+    with lock:
+      try:
+        return self.cache[key]
+      except KeyError:
+        pass
+      row = connection.execute(f'SELECT value FROM {self.name} WHERE key = ?', (key,)).fetchone()
+      if row is None:
+        raise KeyError(key)
+      return self.remember(key, decode(row[0]))
+
+  def __setitem__(self, key, value):
+    with lock:
+      connection.execute(f'INSERT OR REPLACE INTO {self.name} (key, value) VALUES (?, ?)', (key, encode(value)))
+      self.remember(key, value)
+
+  def __delitem__(self, key):
+    with lock:
+      if connection.execute(f'DELETE FROM {self.name} WHERE key = ?', (key,)).rowcount == 0:
+        raise KeyError(key)
+      self.cache.pop(key, None)
+      self.dropped.discard(key)
+
+  def __contains__(self, key):
+    with lock:
+      return key in self.cache or connection.execute(f'SELECT 1 FROM {self.name} WHERE key = ?', (key,)).fetchone() is not None
+
+  def __iter__(self):
+    with lock:
+      return iter([row[0] for row in connection.execute(f'SELECT key FROM {self.name}')])
+
+  def __len__(self):
+    with lock:
+      return connection.execute(f'SELECT COUNT(*) FROM {self.name}').fetchone()[0]
+
+  def __repr__(self):
+    return f'<Table {self.section!r} with {len(self)} entries>'
+
+  def items(self):
+    with lock:
+      return [(key, self.cache[key] if key in self.cache else self.remember(key, decode(value))) for key, value in connection.execute(f'SELECT key, value FROM {self.name}')]
+
+  def values(self):
+    return [value for _, value in self.items()]
+
+  def copy(self):
+    return dict(self.items())
+
+  def flush(self, key=None):
+    # Writes back cached values which might have been changed in place.
+    with lock:
+      for key in list(self.cache) if key is None else [key]:
+        if key in self.cache:
+          connection.execute(f'UPDATE {self.name} SET value = ? WHERE key = ?', (encode(self.cache[key]), key))
+        elif key in self.dropped:
+          # Only values that nothing referred to get dropped, so whatever got
+          # changed here is not what the table will return.
+          logging.warn(f'Touched {self.section}[{key!r}] after it was dropped from the cache, the change may be lost')
+
+  def drop_unused(self):
+    # Called after every save, once all touched values have been written back.
+    with lock:
+      for key in [key for key in self.cache if not is_shared(self.cache, key)]:
+        del self.cache[key]
+        self.dropped.add(key)
+
+  def ranking(self, start, stop):
+    with lock:
+      limit = -1 if stop is None else stop - start
+      return [(key, decode(value)) for key, value in connection.execute(f'SELECT key, value FROM {self.name} ORDER BY value DESC, key LIMIT ? OFFSET ?', (limit, start))]
+
+  def rank_of(self, key):
+    with lock:
+      row = connection.execute(f'SELECT value FROM {self.name} WHERE key = ?', (key,)).fetchone()
+      if row is None:
+        return None
+      return (
+        connection.execute(f'SELECT COUNT(*) FROM {self.name} WHERE value > ?', row).fetchone()[0] +
+        connection.execute(f'SELECT COUNT(*) FROM {self.name} WHERE value = ? AND key < ?', (row[0], key)).fetchone()[0]
+      )
+
+class RankIndex:
+  # The entries of a section ordered like in Table.ranking, kept as a list of
+  # short sorted lists. An update only shifts around the insides of one of
+  # them and a rank is just the lengths of the ones before plus a bisection.
+  bucket_size = 1024
+
+  def __init__(self, section):
+    self.values = dict(section)
+    entries = sorted((-value, key) for key, value in self.values.items())
+    self.buckets = [entries[i:i + self.bucket_size] for i in range(0, len(entries), self.bucket_size)]
+    self.maxes = [i[-1] for i in self.buckets]
+
+  def insert(self, entry):
+    if not self.buckets:
+      self.buckets.append([entry])
+      self.maxes.append(entry)
+      return
+    i = min(bisect_left(self.maxes, entry), len(self.buckets) - 1)
+    bucket = self.buckets[i]
+    insort(bucket, entry)
+    self.maxes[i] = bucket[-1]
+    if len(bucket) > 2 * self.bucket_size:
+      self.buckets[i:i + 1] = [bucket[:self.bucket_size], bucket[self.bucket_size:]]
+      self.maxes[i:i + 1] = [self.buckets[i][-1], self.buckets[i + 1][-1]]
+
+  def remove(self, entry):
+    i = bisect_left(self.maxes, entry)
+    bucket = self.buckets[i]
+    del bucket[bisect_left(bucket, entry)]
+    if bucket:
+      self.maxes[i] = bucket[-1]
+    else:
+      del self.buckets[i]
+      del self.maxes[i]
+
+  def update(self, key, value):
+    if key in self.values:
+      self.remove((-self.values.pop(key), key))
+    if value is not None:
+      self.values[key] = value
+      self.insert((-value, key))
+
+  def ranking(self, start, stop):
+    result = []
+    offset = 0
+    for bucket in self.buckets:
+      if stop is not None and offset >= stop:
+        break
+      if offset + len(bucket) > start:
+        result += bucket[max(start - offset, 0):None if stop is None else stop - offset]
+      offset += len(bucket)
+    return [(key, -value) for value, key in result]
+
+  def rank_of(self, key):
+    if key not in self.values:
+      return None
+    entry = (-self.values[key], key)
+    i = bisect_left(self.maxes, entry)
+    return sum(map(len, self.buckets[:i])) + bisect_left(self.buckets[i], entry)
+
+def rank_index_of(section):
+  if section not in rank_indexes:
+    rank_indexes[section] = RankIndex(data.get(section, {}))
+  return rank_indexes[section]
+
+def ranking(section, start=0, stop=None):
+  # Entries of a section with numerical values from the highest value. Ties
+  # are broken by the key.
+  value = data.get(section, {})
+  if isinstance(value, Table):
+    return value.ranking(start, stop)
+  with lock:
+    return rank_index_of(section).ranking(start, stop)
+
+def rank_of(section, key):
+  value = data.get(section, {})
+  if isinstance(value, Table):
+    return value.rank_of(key)
+  with lock:
+    return rank_index_of(section).rank_of(key)
+
+def segment_path(section, directory=None):
+  assert isinstance(section, str) and '/' not in section and not section.startswith('.')
+  return os.path.join(directory or config['database'] + '.segments', section + '.json')
+
+def read_segment(section):
+  with open(segment_path(section), 'rb') as file:
+    return decode_section(section, loads(file.read()))
+
+def write_segment(section, value, directory=None):
+  # This is not an atomic disk operation, so if we were to save directly to
+  # the segment, then there could be a power outage and we would end up
+  # having a truncated segment to load on next boot.
+  path = segment_path(section, directory)
+  with open(path + '.new', 'w') as file:
+    json.dump(value, file, cls=Encoder)
+    file.flush()
+    os.fsync(file.fileno())
+  os.replace(path + '.new', path)
+  segment_sizes[section] = size_of(path)
+
+def replay(path):
+  try:
+    file = open(path, 'rb+')
+  except FileNotFoundError:
+    return
+
+  with file:
+    count = 0
+    end = 0
+    for line in file:
+      if not line.endswith(b'\n'):
+        break
+      try:
+        record = convert(loads(line))
+      except ValueError:
+        break
+
+      *parents, last = map(maybe_int, record['path'])
+      node = data
+      for key in parents:
+        node = node.setdefault(key, {}) if isinstance(node, dict) else node[key]
+      if 'value' in record:
+        if isinstance(node, list) and last == len(node): # Appended
+          node.append(record['value'])
+        else:
+          node[last] = record['value']
+      else:
+        node.pop(last, None)
+      unsaved_sections.add(record['path'][0])
+
+      count += 1
+      end += len(line)
+
+    if end < os.fstat(file.fileno()).st_size:
+      # We must have crashed in the middle of an append. The record was never
+      # fully written, so nobody relied on it being saved.
+      logging.warn(f'Truncating torn record at the end of {path!r}')
+      file.truncate(end)
+
+  logging.info(f'Replayed {count} records from {path!r}')
 
 def load():
   logging.info('Loading database')
-  with lock:
+  with save_lock, lock:
+    reopen()
+
+def reopen():
+  global connection
+  rank_indexes.clear()
+  if connection is not None:
+    connection.close()
+    connection = None
+  if config['database_backend'] == 'sqlite':
+    load_sqlite()
+  else:
+    load_json()
+
+def load_json():
+  global data, should_save
+  data = Data()
+  unsaved_sections.clear()
+  segment_sizes.clear()
+
+  try:
+    sections = [i.removesuffix('.json') for i in os.listdir(config['database'] + '.segments') if i.endswith('.json')]
+  except FileNotFoundError:
+    sections = None
+
+  if sections is not None:
+    # Most of the time goes into parsing, which is I/O bound only for cold
+    # caches, but it doesn't hurt to overlap the reads of the segments.
+    with ThreadPoolExecutor() as executor:
+      for section, value in zip(sections, executor.map(read_segment, sections)):
+        data[section] = value
+        segment_sizes[section] = size_of(segment_path(section))
+    should_save = False
+  else:
+    # Databases from before segments were a single JSON file.
     try:
-      def object_hook(object):
-        if set(object) == {'__set__'}:
-          return set(object['__set__'])
-        elif set(object) == {'__datetime__'}:
-          return datetime.fromisoformat(object['__datetime__'])
-        else:
-          def maybe_int(x):
-            try:
-              return int(x)
-            except ValueError:
-              return x
-          return {maybe_int(k): v for k, v in object.items()}
-      with open(config['database'], 'r') as file:
-        global data
-        data = json.load(file, object_hook=object_hook)
+      with open(config['database'], 'rb') as file:
+        data.update({k: decode_section(k, v) for k, v in loads(file.read()).items()})
+      logging.info('Converting the database file to segments')
     except FileNotFoundError:
-      data = {}
-    global should_save
-    should_save = False
+      pass
+    should_save = bool(data)
 
+  # The old journal is only left behind when a compaction got interrupted.
+  replay(config['database'] + '.journal.old')
+  replay(config['database'] + '.journal')
+  dirty.clear() # Everything we touched while loading is already on disk.
+
+def load_sqlite():
+  global connection, data, should_save
+  connection = sqlite3.connect(config['database'] + '.sqlite', check_same_thread=False)
+  connection.execute('PRAGMA journal_mode = WAL')
+  connection.execute('PRAGMA synchronous = NORMAL')
+
+  if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'sections'").fetchone() is None:
+    # Start off with the JSON database. This happens in a single transaction, so
+    # that an interrupted import doesn't leave an empty database behind.
+    old_connection, connection = connection, None
+    load_json()
+    json_data, connection = data, old_connection
+    logging.info('Importing the database into SQLite')
+    connection.execute('BEGIN')
+    connection.execute('CREATE TABLE sections (name TEXT PRIMARY KEY, is_table INTEGER NOT NULL, value)')
+    data = Data()
+    data.update(json_data)
+    for section in data:
+      write_section(section)
+    connection.commit()
+  else:
+    data = Data()
+    for name, is_table, value in connection.execute('SELECT name, is_table, value FROM sections'):
+      dict.__setitem__(data, name, Table(name) if is_table else decode(value))
+
+  should_save = False
+  dirty.clear()
+
+def write_section(section):
+  if section not in data:
+    connection.execute('DELETE FROM sections WHERE name = ?', (section,))
+  elif isinstance(data[section], Table):
+    data[section].flush()
+  else:
+    connection.execute('INSERT OR REPLACE INTO sections (name, is_table, value) VALUES (?, 0, ?)', (section, encode(data[section])))
+
+def snapshot(value):
+  # Copying the containers is enough to make a value immune to later changes,
+  # because everything else that we store is immutable.
+  if isinstance(value, dict):
+    result = value.copy()
+    for key, item in result.items():
+      if isinstance(item, (dict, list, set)):
+        result[key] = snapshot(item)
+    return result
+  elif isinstance(value, list):
+    return [snapshot(i) if isinstance(i, (dict, list, set)) else i for i in value]
+  elif isinstance(value, set):
+    return value.copy()
+  else:
+    return value
+
+def record_of(path):
+  node = data
+  try:
+    for key in path:
+      node = node[key]
+  except (KeyError, IndexError):
+    return {'path': path}
+  return {'path': path, 'value': snapshot(node)}
+
+def size_of(path):
+  try:
+    return os.path.getsize(path)
+  except FileNotFoundError:
+    return 0
+
+# The database lock is only held while a save captures a snapshot of what it
+# is going to write. Encoding and disk I/O happen afterwards on the saving
+# thread, so handlers that take the lock don't wait for the disk. Saves are
+# serialized by save_lock instead.
 def save():
   logging.info('Saving database')
-  with lock:
-    assert data is not None
-    global should_save
-    should_save = False
+  with save_lock:
+    begin = time.perf_counter()
+    with lock:
+      assert data is not None
 
-    class Encoder(json.JSONEncoder):
-      def default(self, value):
-        if isinstance(value, set):
-          return {'__set__': list(value)}
-        elif isinstance(value, datetime):
-          return {'__datetime__': value.isoformat()}
-        else:
-          return super().default(value)
-    # This is not an atomic disk operation, so if we were to save directly to
-    # database.json, then there could be a power outage and we would end up
-    # having a truncated database to load on next boot.
-    with open(config['database'] + '.new', 'w') as file:
-      json.dump(data, file, cls=Encoder)
+      paths = dirty.copy()
+      for path in paths: # Paths touched in the meantime by other threads must stay.
+        del dirty[path]
+      # A change to a whole section already covers all changes inside of it.
+      # The order is kept, so that appends to a list get replayed in order.
+      paths = [path for path in paths if not any(path[:i] in paths for i in range(1, len(path)))]
+      if connection is not None:
+        finish = save_sqlite(paths)
+      else:
+        finish = save_json(paths)
+    logging.info(f'Held the database lock for {(time.perf_counter() - begin) * 1000:.1f} ms while saving')
+
+    finish()
+
+def save_json(paths):
+  records = [record_of(path) for path in paths]
+  unsaved_sections.update(path[0] for path in paths)
+
+  # Compacting only once the journal outgrows the segments it would rewrite
+  # keeps the amortized cost of a save proportional to the size of the change.
+  # The size of the journal lags behind by the records of this save, because
+  # they are not encoded yet.
+  unsaved_size = sum(segment_sizes.get(i, 0) for i in unsaved_sections)
+  if should_save or size_of(config['database'] + '.journal') > max(unsaved_size, 64 * 1024):
+    sections = capture_segments()
+  else:
+    sections = None
+
+  def finish():
     try:
-      shutil.copy2(config['database'], config['database'] + '.' + date.today().isoformat())
-    except FileNotFoundError:
+      if records:
+        with open(config['database'] + '.journal', 'a') as file:
+          file.write(''.join(json.dumps(record, cls=Encoder) + '\n' for record in records))
+          file.flush()
+          os.fsync(file.fileno())
+    except:
+      with lock:
+        dirty.update(dict.fromkeys(paths))
+      raise
+    if sections is not None:
+      write_segments(*sections)
+  return finish
+
+def save_sqlite(paths):
+  global should_save
+  sections = set(data) if should_save else set()
+  should_save = False
+  for path in paths:
+    if len(path) >= 2 and isinstance(data.get(path[0]), Table):
+      data[path[0]].flush(path[1])
+    else:
+      sections.add(path[0])
+  for section in sections:
+    write_section(section)
+  connection.commit() # All changes since the last save go in one batch.
+  for value in data.values():
+    if isinstance(value, Table):
+      value.drop_unused()
+  return lambda: None
+
+def compact():
+  logging.info('Compacting database')
+  with save_lock:
+    with lock:
+      assert data is not None
+      if connection is not None:
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return
+      sections = capture_segments()
+    write_segments(*sections)
+
+def capture_segments():
+  global should_save
+  names = set(data) | set(segment_sizes) if should_save else unsaved_sections.copy()
+  should_save = False
+  unsaved_sections.clear()
+  values = {i: snapshot(data[i]) for i in names if i in data}
+  return values, names - values.keys()
+
+def write_segments(values, deleted):
+  # The journal must be moved out of the way before any segment gets replaced,
+  # so that we never end up with a new segment and an empty journal with an
+  # old one. Replaying the old journal onto segments that already include it
+  # is harmless, because they then already hold the final value of every
+  # record.
+  journal = config['database'] + '.journal'
+  try:
+    if not os.path.exists(journal):
       pass
-    os.replace(config['database'] + '.new', config['database'])
+    elif os.path.exists(journal + '.old'):
+      with open(journal, 'r') as src, open(journal + '.old', 'a') as dst:
+        shutil.copyfileobj(src, dst)
+        dst.flush()
+        os.fsync(dst.fileno())
+      os.remove(journal)
+    else:
+      os.replace(journal, journal + '.old')
+
+    segments = config['database'] + '.segments'
+    if os.path.isdir(segments):
+      for section, value in values.items():
+        write_segment(section, value)
+    else:
+      # load_json() prefers segments over the old single file as soon as their
+      # directory exists, so the first conversion is written to a temporary
+      # directory that only gets renamed once it's complete.
+      shutil.rmtree(segments + '.new', ignore_errors=True)
+      os.makedirs(segments + '.new')
+      for section, value in values.items():
+        write_segment(section, value, segments + '.new')
+      os.rename(segments + '.new', segments)
+    for section in deleted:
+      if section in segment_sizes:
+        os.remove(segment_path(section))
+        del segment_sizes[section]
+  except:
+    with lock:
+      unsaved_sections.update(values.keys() | deleted)
+    raise
+  logging.info(f'Rewrote {len(values) + len(deleted)} segments')
+
+  try:
+    os.remove(journal + '.old')
+  except FileNotFoundError:
+    pass
+
+# Big binary values like images are kept outside of the database file, so that
+# they don't get reencoded on every save. They are addressed by their hash and
+# never change after being written.
+def blob_path(key):
+  return os.path.join(config['database'] + '.blobs', key[:2], key)
+
+def put_blob(content):
+  key = sha256(content).hexdigest()
+  path = blob_path(key)
+  if not os.path.exists(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.new', 'wb') as file:
+      file.write(content)
+      file.flush()
+      os.fsync(file.fileno())
+    os.replace(path + '.new', path)
+  return key
+
+def delete_blob(key):
+  try:
+    os.remove(blob_path(key))
+  except FileNotFoundError:
+    pass
+
+def list_blobs():
+  try:
+    dirs = os.listdir(config['database'] + '.blobs')
+  except FileNotFoundError:
+    return []
+  return [key for dir in dirs for key in os.listdir(os.path.join(config['database'] + '.blobs', dir)) if not key.endswith('.new')]
+
+# Backups are taken once a day. Every file of the database is stored compressed
+# under its hash, so files that haven't changed since the previous backup, like
+# most segments, are shared with it instead of being copied again. A backup
+# itself is just a small manifest of the hashes.
+def backup_path(*parts):
+  return os.path.join(config['database'] + '.backups', *parts)
+
+def write_file(path, content):
+  with open(path + '.new', 'wb') as file:
+    file.write(content)
+    file.flush()
+    os.fsync(file.fileno())
+  os.replace(path + '.new', path)
+
+def put_backup_object(content):
+  digest = sha256(content).hexdigest()
+  for suffix in ['.zst', '.gz']:
+    if os.path.exists(backup_path('objects', digest[:2], digest + suffix)):
+      return digest + suffix
+  if zstandard is not None:
+    key, content = digest + '.zst', zstandard.ZstdCompressor().compress(content)
+  else:
+    key, content = digest + '.gz', gzip.compress(content)
+  path = backup_path('objects', key[:2], key)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  write_file(path, content)
+  return key
+
+def put_backup_file(path):
+  with open(path, 'rb') as file:
+    return put_backup_object(file.read())
+
+def get_backup_object(key):
+  with open(backup_path('objects', key[:2], key), 'rb') as file:
+    content = file.read()
+  if key.endswith('.gz'):
+    return gzip.decompress(content)
+  elif zstandard is None:
+    raise Exception('Restoring this backup requires the zstandard module')
+  else:
+    return zstandard.ZstdDecompressor().decompress(content)
+
+def backup():
+  logging.info('Backing up database')
+  # Only the files are read here, so saves are the only thing to keep away.
+  with save_lock:
+    os.makedirs(backup_path(), exist_ok=True)
+    if connection is not None:
+      # A connection of our own reads the committed state.
+      path = backup_path('sqlite.new')
+      source = sqlite3.connect(config['database'] + '.sqlite')
+      target = sqlite3.connect(path)
+      source.backup(target)
+      target.close()
+      source.close()
+      manifest = {'sqlite': put_backup_file(path)}
+      os.remove(path)
+    else:
+      manifest = {'segments': {}, 'journals': {}}
+      for section in list(segment_sizes):
+        manifest['segments'][section] = put_backup_file(segment_path(section))
+      for suffix in ['.journal.old', '.journal']:
+        if os.path.exists(config['database'] + suffix):
+          manifest['journals'][suffix] = put_backup_file(config['database'] + suffix)
+    # Blobs never change, so after the first backup they are always shared.
+    manifest['blobs'] = {}
+    for key in list_blobs():
+      try:
+        manifest['blobs'][key] = put_backup_file(blob_path(key))
+      except FileNotFoundError: # Deleted in the meantime
+        pass
+    write_file(backup_path(date.today().isoformat() + '.json'), json.dumps(manifest).encode())
+    prune_backups()
+
+def list_backups():
+  try:
+    return sorted(i.removesuffix('.json') for i in os.listdir(backup_path()) if i.endswith('.json'))
+  except FileNotFoundError:
+    return []
+
+def read_manifest(name):
+  with open(backup_path(name + '.json'), 'r') as file:
+    return json.load(file)
+
+def prune_backups():
+  names = list_backups()
+  kept = set()
+  # The newest backup of each of the last few days, weeks and months survives.
+  for count, period_of in [
+    (config['backup_days'], lambda x: x),
+    (config['backup_weeks'], lambda x: x.isocalendar()[:2]),
+    (config['backup_months'], lambda x: (x.year, x.month)),
+  ]:
+    newest = {}
+    for name in reversed(names):
+      newest.setdefault(period_of(date.fromisoformat(name)), name)
+    kept.update(list(newest.values())[:count])
+
+  for name in names:
+    if name not in kept:
+      logging.info(f'Removing backup {name!r}')
+      os.remove(backup_path(name + '.json'))
+
+  used = set()
+  for name in kept:
+    manifest = read_manifest(name)
+    used.update(manifest.get('segments', {}).values())
+    used.update(manifest.get('journals', {}).values())
+    used.update(manifest.get('blobs', {}).values())
+    if 'sqlite' in manifest:
+      used.add(manifest['sqlite'])
+  try:
+    dirs = os.listdir(backup_path('objects'))
+  except FileNotFoundError:
+    dirs = []
+  for dir in dirs:
+    for key in os.listdir(backup_path('objects', dir)):
+      if key not in used:
+        os.remove(backup_path('objects', dir, key))
+
+def restore(name):
+  logging.info(f'Restoring database from backup {name!r}')
+  manifest = read_manifest(name)
+  if ('sqlite' in manifest) != (config['database_backend'] == 'sqlite'):
+    raise Exception('The backup was made with a different database backend')
+
+  with save_lock, lock:
+    global connection
+    if connection is not None:
+      connection.close()
+      connection = None
+
+    if 'sqlite' in manifest:
+      for suffix in ['-wal', '-shm']:
+        try:
+          os.remove(config['database'] + '.sqlite' + suffix)
+        except FileNotFoundError:
+          pass
+      write_file(config['database'] + '.sqlite', get_backup_object(manifest['sqlite']))
+    else:
+      os.makedirs(config['database'] + '.segments', exist_ok=True)
+      for section, key in manifest['segments'].items():
+        write_file(segment_path(section), get_backup_object(key))
+      for section in list(segment_sizes):
+        if section not in manifest['segments']:
+          os.remove(segment_path(section))
+      for suffix in ['.journal.old', '.journal']:
+        if suffix in manifest['journals']:
+          write_file(config['database'] + suffix, get_backup_object(manifest['journals'][suffix]))
+        else:
+          try:
+            os.remove(config['database'] + suffix)
+          except FileNotFoundError:
+            pass
+
+    # Blobs that appeared since the backup are left alone, nothing restored
+    # refers to them.
+    for key, object_key in manifest.get('blobs', {}).items():
+      if not os.path.exists(blob_path(key)):
+        os.makedirs(os.path.dirname(blob_path(key)), exist_ok=True)
+        write_file(blob_path(key), get_backup_object(object_key))
+
+    reopen()
 
 autosave_thread = None
 autosave_stop = None
@@ -90,8 +920,13 @@ def start():
     autosave_stop.clear()
     while not autosave_stop.is_set():
       autosave_stop.wait(timeout=parse_duration(config['autosave']))
-      if should_save:
+      if should_save or dirty:
         save()
+      if date.today().isoformat() not in list_backups():
+        try:
+          backup()
+        except Exception:
+          logging.exception('Got exception while backing up database')
   autosave_thread = threading.Thread(target=autosave)
   autosave_thread.start()
 
@@ -107,9 +942,13 @@ def stop():
   autosave_thread = None
 
 console.begin('database')
-console.register('data',  None, 'prints the database',          lambda: data)
-console.register('load',  None, 'loads the database from file', load)
-console.register('save',  None, 'saves the database to file',   save)
-console.register('start', None, 'starts the database',          start)
-console.register('stop',  None, 'stops the database',           stop)
+console.register('data',    None,     'prints the database',                    lambda: data)
+console.register('load',    None,     'loads the database from file',           load)
+console.register('save',    None,     'saves the database to file',             save)
+console.register('compact', None,     'compacts the journal or the WAL',        compact)
+console.register('backup',  None,     'backs up the database',                  backup)
+console.register('backups', None,     'lists the backups',                      list_backups)
+console.register('restore', '<date>', 'restores the database from a backup',    restore)
+console.register('start',   None,     'starts the database',                    start)
+console.register('stop',    None,     'stops the database',                     stop)
 console.end()
@@ -23,6 +23,13 @@ from common import config, hybrid_check, loop, pages_view
 
 bot = None
 lock = asyncio.Lock()
+# The winners of the days in the window, kept up to date by check(), and how
+# many days each user has won
+winners = {}
+scores = database.RankIndex({})
+window_start = None # The oldest date in the window as an ISO string
+
+database.schemas['budzik_first_pings'] = database.keyed_by_str(database.keyed_by_int(database.as_datetime))
 
 class NoBudzikRolesError(discord.app_commands.CheckFailure):
   pass
@@ -32,6 +39,44 @@ def check_budzik_roles(interaction):
   if not config['budzik_roles']:
     raise NoBudzikRolesError()
 
+def winner_of(date):
+  _, hour, minute = config['budzik_roles'][0]
+  first_pings = [i for i in database.data.get('budzik_first_pings', {}).get(date, {}).items() if i[1].hour == hour and i[1].minute == minute]
+  return min(first_pings, key=lambda x: x[1])[0] if first_pings else None
+
+def set_winner(date, user):
+  old = winners.pop(date, None)
+  if old is not None:
+    scores.update(old, scores.values[old] - 1 or None)
+  if user is not None:
+    winners[date] = user
+    scores.update(user, scores.values.get(user, 0) + 1)
+
+def advance_window():
+  # Forgets the days which fell out of the window, pings included.
+  global window_start
+  today = datetime.now(ZoneInfo(config['timezone'])).date()
+  start = (today - timedelta(days=config['budzik_max_age_days'])).isoformat()
+  if start == window_start:
+    return
+  window_start = start
+  for date in [i for i in winners if i < start]:
+    set_winner(date, None)
+  first_pings = database.data.get('budzik_first_pings', {})
+  for date in [i for i in first_pings if i < start]:
+    logging.info(f'Forgetting #budzik pings from {date}')
+    del first_pings[date]
+    database.touch('budzik_first_pings', date)
+
+def rebuild():
+  global scores, window_start
+  winners.clear()
+  scores = database.RankIndex({})
+  window_start = None
+  advance_window()
+  for date in database.data.get('budzik_first_pings', {}):
+    set_winner(date, winner_of(date))
+
 async def check(msg):
   if msg.channel.id != config['budzik_channel'] or not config['budzik_roles'] or all(i.id != config['budzik_roles'][0][0] for i in msg.role_mentions):
     return
@@ -39,12 +84,18 @@ async def check(msg):
   logging.info(f'User {msg.author.id} pinged role {config["budzik_roles"][0][0]} at {time}')
   date = time.date().isoformat()
   async with lock:
+    advance_window()
+    if date < window_start:
+      return
     if time <= database.data.setdefault('budzik_first_pings', {}).setdefault(date, {}).get(msg.author.id, time):
       database.data['budzik_first_pings'][date][msg.author.id] = time
-      database.should_save = True
+      database.touch('budzik_first_pings', date, msg.author.id)
+      set_winner(date, winner_of(date))
 
 async def check_all():
   logging.info('Checking all relevant #budzik messages')
+  async with lock:
+    rebuild()
   after = datetime.now().astimezone() - timedelta(days=config['budzik_max_age_days'] + 1)
   async for msg in bot.get_channel(config['budzik_channel']).history(after=after, limit=None):
     await check(msg)
@@ -53,6 +104,9 @@ async def setup(_bot):
   global bot
   bot = _bot
 
+  if config['budzik_roles']:
+    rebuild()
+
   @bot.on_check_failure
   async def on_check_failure(interaction, error):
     if isinstance(error, NoBudzikRolesError):
@@ -68,40 +122,22 @@ async def setup(_bot):
   @check_budzik_roles
   async def budzik(interaction):
     role, hour, minute = config['budzik_roles'][0]
+    advance_window()
 
-    ranking = {}
-    today = datetime.now(ZoneInfo(config['timezone'])).date()
-    date = today - timedelta(days=config['budzik_max_age_days'])
-    while date <= today:
-      first_pings = filter(lambda x: x[1].hour == hour and x[1].minute == minute, database.data.get('budzik_first_pings', {}).get(date.isoformat(), {}).items())
-      try:
-        user = min(first_pings, key=lambda x: x[1])[0]
-      except ValueError:
-        pass
-      else:
-        ranking.setdefault(user, 0)
-        ranking[user] += 1
-      date += timedelta(days=1)
-    ranking = sorted(ranking.items(), key=lambda x: x[1], reverse=True)
-
-    if not ranking:
+    if not scores.values:
       await interaction.response.send_message(f'Nikt jeszcze nie spingował <@&{role}> o {hour}:{minute:02} w ostatnim czasie. 😔', ephemeral=True)
       return
 
     def contents_of(page):
       result = f'Ranking użytkowników według liczby najszybszych pingów <@&{role}> w ostatnim czasie: 🏃\n'
-      for i in range(20 * page, 20 * (page + 1)):
-        try:
-          user, score = ranking[i]
-        except IndexError:
-          break
+      for i, (user, score) in enumerate(scores.ranking(20 * page, 20 * (page + 1)), 20 * page):
         result += f'{i + 1}. <@{user}> z **{score}** ' + ('najszybszym pingiem\n' if score == 1 else 'najszybszymi pingami\n')
       return result
 
     async def on_select_page(interaction2, page):
       await interaction2.response.defer()
       await interaction2.edit_original_response(content=contents_of(page), view=view)
-    view = pages_view(0, (len(ranking) + 20 - 1) // 20, on_select_page, interaction.user)
+    view = pages_view(0, (len(scores.values) + 20 - 1) // 20, on_select_page, interaction.user)
 
     await interaction.response.send_message(contents_of(0), view=view, ephemeral=True)
 
@@ -19,9 +19,13 @@ from datetime import datetime
 
 import console, database
 from common import config, hybrid_check, pages_view
+from features.utils import delete_soon
 
 bot = None
 lock = asyncio.Lock()
+is_recalculating = False
+
+database.schemas['counting_score'] = database.keyed_by_int()
 
 class NoCountingChannelError(discord.app_commands.CheckFailure):
   pass
@@ -43,72 +47,86 @@ async def setup(_bot):
       raise
 
   bad_messages = set()
-
-  async def clean():
-    if config['counting_channel'] is None:
+  # Whether every message up to now has gone through handle(). Only then can
+  # new messages be checked straight from their events.
+  is_caught_up = False
+
+  async def handle(msg):
+    # The whole state of the game is the next number and the time of the last
+    # correct message, which is also where the catch-up starts from.
+    try:
+      num = int(msg.content, 0)
+    except ValueError:
+      num = None
+    if num is None or num != database.data.get('counting_num', num) or msg.author.bot:
+      bad_messages.add(msg.id) # Bulk deletions don't cause on_message_delete but single ones do.
+      delete_soon(msg)
       return
 
+    if 'counting_num' in database.data:
+      logging.info(f'{msg.author.id} has upped the counting number to {num}')
+    else:
+      logging.info(f'{msg.author.id} has called the initial counting number at {num}')
+
+    database.data['counting_num'] = num + 1
+    database.data['counting_clean_until'] = msg.created_at
+    database.data['counting_score'][msg.author.id] = database.data.setdefault('counting_score', {}).get(msg.author.id, 0) + 1
+    database.touch('counting_num')
+    database.touch('counting_clean_until')
+    database.touch('counting_score', msg.author.id)
+
+  async def catch_up():
+    nonlocal is_caught_up
     if 'counting_clean_until' not in database.data:
       logging.info('#counting has never been cleaned before')
       database.data['counting_clean_until'] = datetime.now().astimezone()
-      database.should_save = True
+      database.touch('counting_clean_until')
 
-    async with lock:
-      async for msg in bot.get_channel(config['counting_channel']).history(limit=None, after=database.data['counting_clean_until']):
-        try:
-          num = int(msg.content, 0)
-        except ValueError:
-          bad_messages.add(msg.id)
-          await msg.delete()
-        else:
-          if num == database.data.get('counting_num', num) and not msg.author.bot:
-            if 'counting_num' in database.data:
-              logging.info(f'{msg.author.id} has upped the counting number to {num}')
-            else:
-              logging.info(f'{msg.author.id} has called the initial counting number at {num}')
-
-            database.data['counting_num'] = num + 1
-            database.data['counting_clean_until'] = msg.created_at
-            database.data['counting_score'][msg.author.id] = database.data.setdefault('counting_score', {}).get(msg.author.id, 0) + 1
-            database.should_save = True
-          else:
-            bad_messages.add(msg.id)
-            await msg.delete()
+    async for msg in bot.get_channel(config['counting_channel']).history(limit=None, after=database.data['counting_clean_until']):
+      await handle(msg)
+    is_caught_up = True
 
   @bot.listen()
   async def on_ready():
+    # This also fires after reconnecting with a new session, in which case we
+    # could have missed some messages. Resumed sessions replay them instead.
+    nonlocal is_caught_up
+    if config['counting_channel'] is None:
+      return
     logging.info('Cleaning #counting')
-    await clean()
+    async with lock:
+      is_caught_up = False
+      await catch_up()
     logging.info('Counting is ready')
 
   @bot.listen()
   async def on_message(msg):
     if msg.channel.id == config['counting_channel']:
-      logging.info('Cleaning #counting after a new message')
-      await clean() # on_message can come before on_ready.
+      async with lock:
+        if not is_caught_up:
+          logging.info('Cleaning #counting after a new message')
+          await catch_up() # on_message can come before on_ready.
+        elif msg.created_at > database.data['counting_clean_until']: # The catch-up may have already seen it.
+          await handle(msg)
 
   @bot.tree.command(description='Wyświetla ranking kanału #liczenie')
   @check_counting_channel
   async def counting(interaction):
-    ranking = sorted(database.data.get('counting_score', {}).items(), key=lambda x: x[1], reverse=True)
-    if not ranking:
+    count = len(database.data.get('counting_score', {}))
+    if count == 0:
       await interaction.response.send_message(f'Nikt jeszcze nie skorzystał z <#{config["counting_channel"]}>. 😴', ephemeral=True)
       return
 
     def contents_of(page):
       result = f'Ranking najbardziej aktywnych użytkowników <#{config["counting_channel"]}>: 🔢\n'
-      for i in range(20 * page, 20 * (page + 1)):
-        try:
-          user, score = ranking[i]
-        except IndexError:
-          break
+      for i, (user, score) in enumerate(database.ranking('counting_score', 20 * page, 20 * (page + 1)), 20 * page):
         result += f'{i + 1}. <@{user}> z **{score}** ' + ('wysłaną wiadomością\n' if score == 1 else 'wysłanymi wiadomościami\n')
       return result
 
     async def refresh(interaction2, page):
       await interaction2.response.defer()
       await interaction2.edit_original_response(content=contents_of(page), view=view)
-    view = pages_view(0, (len(ranking) + 20 - 1) // 20, refresh, interaction.user)
+    view = pages_view(0, (count + 20 - 1) // 20, refresh, interaction.user)
 
     await interaction.response.send_message(contents_of(0), view=view, ephemeral=True)
 
@@ -119,16 +137,86 @@ async def setup(_bot):
         if msg.id not in bad_messages: # We have no other way of checking if we caused this event.
           logging.info(f'{msg.author.id} deleted their message in #counting')
           database.data['counting_score'][msg.author.id] -= 1
-          database.should_save = True
+          database.touch('counting_score', msg.author.id)
 
+# The history up to the start of the recalculation is split into ranges of
+# message IDs, which get scanned concurrently. Their tallies are checkpointed
+# in the database, so an interrupted recalculation continues where it stopped
+# the next time it is run. The ranking is only replaced once everything has
+# been counted.
 async def recalc():
-  logging.info('Recalculating the counting ranking')
-  async with lock:
-    database.data['counting_score'] = {}
-    async for msg in bot.get_channel(config['counting_channel']).history(limit=None):
-      database.data['counting_score'][msg.author.id] = database.data['counting_score'].get(msg.author.id, 0) + 1
-    database.should_save = True
+  global is_recalculating
+  if is_recalculating:
+    raise Exception('The counting ranking is already being recalculated')
+  is_recalculating = True
+  try:
+    channel = bot.get_channel(config['counting_channel'])
+    if 'counting_recalc' in database.data:
+      logging.info('Resuming the recalculation of the counting ranking')
+    else:
+      logging.info('Recalculating the counting ranking')
+      start, stop = channel.id, discord.utils.time_snowflake(datetime.now().astimezone())
+      bounds = [start + (stop - start) * i // config['counting_recalc_ranges'] for i in range(config['counting_recalc_ranges'] + 1)]
+      database.data['counting_recalc'] = {
+        'before': stop,
+        'ranges': [{'after': after, 'before': before, 'tally': {}, 'is_done': False} for after, before in zip(bounds, bounds[1:])],
+      }
+    state = database.data['counting_recalc']
+
+    semaphore = asyncio.Semaphore(config['counting_recalc_workers'])
+    async def scan(i):
+      async with semaphore:
+        part = state['ranges'][i]
+        if part['is_done']:
+          return
+        after = part['after']
+        tally = part['tally'].copy()
+        count = 0
+        async for msg in channel.history(limit=None, after=discord.Object(after), before=discord.Object(part['before']), oldest_first=True):
+          tally[msg.author.id] = tally.get(msg.author.id, 0) + 1
+          after = msg.id
+          count += 1
+          if count % 1000 == 0:
+            # A checkpoint replaces the whole range at once, so that a save
+            # never sees a tally that doesn't match its position.
+            state['ranges'][i] = {**part, 'after': after, 'tally': tally.copy()}
+            database.touch('counting_recalc', 'ranges', i)
+        state['ranges'][i] = {**part, 'after': after, 'tally': tally, 'is_done': True}
+        database.touch('counting_recalc', 'ranges', i)
+        logging.info(f'Counting ranking recalculation: {recalc_progress()}')
+    tasks = [asyncio.create_task(scan(i)) for i in range(len(state['ranges']))]
+    try:
+      await asyncio.gather(*tasks)
+    finally:
+      # The other scans must not outlive a failed one, or they would race with
+      # the next recalculation once is_recalculating gets reset.
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+    async with lock:
+      scores = {}
+      for part in state['ranges']:
+        for user, count in part['tally'].items():
+          scores[user] = scores.get(user, 0) + count
+      # Messages sent since the start went only into the old ranking.
+      async for msg in channel.history(limit=None, after=discord.Object(state['before'])):
+        scores[msg.author.id] = scores.get(msg.author.id, 0) + 1
+      database.data['counting_score'] = scores
+      del database.data['counting_recalc']
+    logging.info('Recalculated the counting ranking')
+  finally:
+    is_recalculating = False
+
+def recalc_progress():
+  if 'counting_recalc' not in database.data:
+    return 'No recalculation in progress'
+  ranges = database.data['counting_recalc']['ranges']
+  done = sum(i['is_done'] for i in ranges)
+  count = sum(sum(i['tally'].values()) for i in ranges)
+  return f'{done}/{len(ranges)} ranges done, {count} messages counted'
 
 console.begin('counting')
-console.register('recalc', None, 'recalculates the counting ranking', lambda: asyncio.run_coroutine_threadsafe(recalc(), bot.loop).result())
+console.register('recalc',          None, 'recalculates the counting ranking, resuming if interrupted', lambda: asyncio.run_coroutine_threadsafe(recalc(), bot.loop).result())
+console.register('recalc_progress', None, 'shows the progress of the recalculation',                   recalc_progress)
 console.end()
@@ -135,7 +135,7 @@ async def setup(_bot):
     if 'fajne_zadanka_clean_until' not in database.data:
       logging.info('#fajne-zadanka has never been cleaned before')
       database.data['fajne_zadanka_clean_until'] = datetime.now().astimezone()
-      database.should_save = True
+      database.touch('fajne_zadanka_clean_until')
 
     async with lock:
       async for msg in bot.get_channel(config['fajne_zadanka_channel']).history(limit=None, after=database.data['fajne_zadanka_clean_until']):
@@ -180,7 +180,7 @@ async def setup(_bot):
         await msg.author.send(f'Zareaguj ❌ na [swoją wiadomość]({my_msg.jump_url}), gdy będziesz chciał ją usunąć. 😊')
 
         database.data['fajne_zadanka_clean_until'] = msg.created_at
-        database.should_save = True
+        database.touch('fajne_zadanka_clean_until')
 
   @bot.listen()
   async def on_ready():
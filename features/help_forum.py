@@ -14,14 +14,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import asyncio, discord, logging
+import asyncio, discord, logging, time
 from datetime import datetime, timedelta
 
-import database
+import console, database
 from common import config, hybrid_check, loop, pages_view, parse_duration
 
 bot = None
 
+database.schemas['help_forum_karma'] = database.keyed_by_int()
+database.schemas['help_forum_posts'] = database.keyed_by_int(lambda x: database.convert(x) if isinstance(x, dict) else x) # Old posts are dicts with datetimes, see migrate_posts
+
 class NoHelpForumChannelError(discord.app_commands.CheckFailure):
   pass
 
@@ -30,10 +33,173 @@ def check_help_forum_channel(interaction):
   if config['help_forum_channel'] is None:
     raise NoHelpForumChannelError()
 
+def is_too_old(post_id, now):
+  return config['help_forum_eval_max_age'] is not None and discord.utils.snowflake_time(post_id) + timedelta(seconds=parse_duration(config['help_forum_eval_max_age'])) < now
+
+# There can be a lot of posts, so each one is stored compactly as
+# [last_eval, contribs], where contribs is a list of [user, contrib count,
+# last_contrib] and times are Unix timestamps.
+def shares_of(post):
+  total = sum(i[1] for i in post[1])
+  return [(user, count / total) for user, count, _ in post[1]]
+
+def migrate_posts():
+  # Posts used to be dicts with datetimes.
+  posts = database.data.get('help_forum_posts', {})
+  is_changed = False
+  for post_id, post in posts.items():
+    if isinstance(post, dict):
+      last_contrib = post.get('last_contrib', {})
+      posts[post_id] = [
+        post['last_eval'].timestamp(),
+        [[user, count, last_contrib[user].timestamp() if user in last_contrib else 0] for user, count in post['contribs'].items()],
+      ]
+      is_changed = True
+  if is_changed:
+    logging.info('Migrated help forum posts to the compact format')
+    database.touch('help_forum_posts')
+
+# Karma is kept up to date by contribute() as messages come in. Every post
+# splits one point between its contributors, so a new contribution changes
+# the shares of all of them.
+def contribute(post_id, msg):
+  if is_too_old(post_id, msg.created_at):
+    return
+  now = msg.created_at.timestamp()
+  post = database.data.setdefault('help_forum_posts', {}).setdefault(post_id, [now, []])
+  post[0] = max(post[0], now)
+  database.touch('help_forum_posts', post_id)
+
+  user = msg.author.id
+  if user == msg.channel.owner_id or msg.author.bot or msg.is_system():
+    return
+  contrib = next((i for i in post[1] if i[0] == user), None)
+  if contrib is not None and now - contrib[2] < parse_duration(config['help_forum_contrib_cooldown']):
+    return
+
+  karma = database.data.setdefault('help_forum_karma', {})
+  for account, share in shares_of(post):
+    karma[account] = karma.get(account, 0) - share
+  if contrib is None:
+    post[1].append([user, 1, now])
+  else:
+    contrib[1] += 1
+    contrib[2] = now
+  for account, share in shares_of(post):
+    karma[account] = karma.get(account, 0) + share
+    database.touch('help_forum_karma', account)
+
+def recalc_karma():
+  # Also drops the posts which got too old and any rounding errors accumulated
+  # by contribute().
+  now = datetime.now().astimezone()
+  posts = database.data.get('help_forum_posts', {})
+  for post_id in [i for i in posts if is_too_old(i, now)]:
+    del posts[post_id]
+    database.touch('help_forum_posts', post_id)
+
+  karma = {}
+  for post in posts.values():
+    for user, share in shares_of(post):
+      karma[user] = karma.get(user, 0) + share
+  database.data['help_forum_karma'] = karma
+
+async def award():
+  awarded = set()
+  for user, _ in database.ranking('help_forum_karma'):
+    if len(awarded) >= config['help_forum_award_count']:
+      break
+    member = bot.get_guild(config['guild']).get_member(user)
+    if member is not None:
+      awarded.add(member)
+
+  for member in bot.get_guild(config['guild']).get_role(config['help_forum_award_role']).members:
+    if member not in awarded:
+      await member.remove_roles(discord.Object(config['help_forum_award_role']))
+  for member in awarded:
+    if member.get_role(config['help_forum_award_role']) is None and config['help_forum_award_channel'] is not None:
+      announcement = f'{member.mention} właśnie wszedł w top {config["help_forum_award_count"]} najbardziej pomocnych użytkowników! Dziękujemy! ❤️'
+      await bot.get_channel(config['help_forum_award_channel']).send(announcement, allowed_mentions=discord.AllowedMentions.all())
+    await member.add_roles(discord.Object(config['help_forum_award_role']))
+
+# Rereads every post that changed since it was last evaluated. Only needed to
+# repair the contributions after messages were missed, e.g. while the bot was
+# down. Deletions don't change the last message of a post, so repairing after
+# them needs force, which rereads every post that's not too old.
+async def rescan(force=False):
+  logging.info('Rescanning the help forum' + (' from scratch' if force else ''))
+
+  start = time.monotonic()
+  now = datetime.now().astimezone()
+  contrib_cooldown = parse_duration(config['help_forum_contrib_cooldown'])
+  listed = reread = too_old = 0
+  async def eval_post(post, is_archived):
+    nonlocal reread, too_old
+    if is_too_old(post.id, now):
+      too_old += 1
+      return
+
+    try:
+      last_update = post.archive_timestamp if is_archived else (await anext(post.history(limit=1))).created_at
+    except StopAsyncIteration:
+      last_update = now
+    if post.id not in database.data.setdefault('help_forum_posts', {}) or force or database.data['help_forum_posts'][post.id][0] < last_update.timestamp():
+      reread += 1
+      contribs = {}
+      last_contrib = {}
+      async for msg in post.history(limit=None, oldest_first=True):
+        user = msg.author.id
+        if user == post.owner_id or msg.author.bot or msg.is_system() or (user in last_contrib and (msg.created_at - last_contrib[user]).total_seconds() < contrib_cooldown):
+          continue
+        try:
+          contribs[user] += 1
+        except KeyError:
+          contribs[user] = 1
+        last_contrib[user] = msg.created_at
+      database.data['help_forum_posts'][post.id] = [now.timestamp(), [[user, count, last_contrib[user].timestamp()] for user, count in contribs.items()]]
+      database.touch('help_forum_posts', post.id)
+
+  # The listing of the posts is paginated by a producer, while a few workers
+  # read the histories of the posts it has listed so far.
+  forum = bot.get_channel(config['help_forum_channel'])
+  queue = asyncio.Queue(2 * config['help_forum_rescan_workers'])
+  async def produce():
+    nonlocal listed
+    for post in forum.threads:
+      listed += 1
+      await queue.put((post, False))
+    # Archived posts come from the most recently archived, and a post
+    # archived too long ago must have also been created too long ago.
+    async for post in forum.archived_threads(limit=None):
+      if config['help_forum_eval_max_age'] is not None and post.archive_timestamp + timedelta(seconds=parse_duration(config['help_forum_eval_max_age'])) < now:
+        break
+      listed += 1
+      await queue.put((post, True))
+    for _ in range(config['help_forum_rescan_workers']):
+      await queue.put(None)
+  async def work():
+    while (item := await queue.get()) is not None:
+      await eval_post(*item)
+
+  tasks = [asyncio.create_task(produce())] + [asyncio.create_task(work()) for _ in range(config['help_forum_rescan_workers'])]
+  try:
+    await asyncio.gather(*tasks)
+  finally:
+    for task in tasks:
+      task.cancel()
+
+  recalc_karma()
+  await award()
+  result = f'Rescanned the help forum in {time.monotonic() - start:.1f}s: listed {listed} posts, reread {reread}, skipped {too_old} as too old'
+  logging.info(result)
+  return result
+
 async def setup(_bot):
   global bot
   bot = _bot
 
+  migrate_posts()
+
   @bot.on_check_failure
   async def on_check_failure(interaction, error):
     if isinstance(error, NoHelpForumChannelError):
@@ -43,35 +209,31 @@ async def setup(_bot):
 
   @bot.listen()
   async def on_message(msg):
-    if msg.id == msg.channel.id and msg.channel.parent_id == config['help_forum_channel'] and config['help_forum_ping_channel'] is not None:
+    if not isinstance(msg.channel, discord.Thread) or msg.channel.parent_id != config['help_forum_channel'] or config['help_forum_channel'] is None:
+      return
+    contribute(msg.channel.id, msg)
+    if msg.id == msg.channel.id and config['help_forum_ping_channel'] is not None:
       mention = f'<@&{config["help_forum_ping_role"]}>' if config['help_forum_ping_role'] is not None else ''
       await bot.get_channel(config['help_forum_ping_channel']).send(f'{mention} Ktoś potrzebuje pomocy na {msg.channel.mention}! 🆘', allowed_mentions=discord.AllowedMentions.all())
 
-  def get_ranking():
-    return sorted(database.data.get('help_forum_karma', {}).items(), key=lambda x: x[1], reverse=True)
-
   @bot.tree.command(description='Wyświetla najbardziej pomocnych użytkowników w ostatnim czasie')
   @check_help_forum_channel
   async def helpful(interaction):
-    ranking = get_ranking()
-    if not ranking:
+    count = len(database.data.get('help_forum_karma', {}))
+    if count == 0:
       await interaction.response.send_message(f'Nikt jeszcze nie pomógł nikomu na <#{config["help_forum_channel"]}>. 😔', ephemeral=True)
       return
 
     def contents_of(page):
       result = 'Ranking najbardziej pomocnych użytkowników w ostatnim czasie: ❤️\n'
-      for i in range(10 * page, 10 * (page + 1)):
-        try:
-          user, karma = ranking[i]
-        except IndexError:
-          break
+      for i, (user, karma) in enumerate(database.ranking('help_forum_karma', 10 * page, 10 * (page + 1)), 10 * page):
         result += f'{i + 1}. <@{user}> z **{karma:.2f}** rozwiązanymi pytaniami\n'
       return result
 
     async def on_select_page(interaction2, page):
       await interaction2.response.defer()
       await interaction2.edit_original_response(content=contents_of(page), view=view)
-    view = pages_view(0, (len(ranking) + 10 - 1) // 10, on_select_page, interaction.user)
+    view = pages_view(0, (count + 10 - 1) // 10, on_select_page, interaction.user)
 
     await interaction.response.send_message(contents_of(0), view=view, ephemeral=True)
 
@@ -82,67 +244,12 @@ async def setup(_bot):
       return
 
     logging.info('Periodically evaluating help forum karma')
-
-    now = datetime.now().astimezone()
-    eval_max_age = parse_duration(config['help_forum_eval_max_age']) if config['help_forum_eval_max_age'] is not None else None
-    contrib_cooldown = parse_duration(config['help_forum_contrib_cooldown'])
-    async def eval_post(post, is_archived):
-      if eval_max_age is not None and post.created_at + timedelta(seconds=eval_max_age) < now:
-        return
-
-      try:
-        last_update = post.archive_timestamp if is_archived else (await anext(post.history(limit=1))).created_at
-      except StopAsyncIteration:
-        last_update = now
-      if post.id not in database.data.setdefault('help_forum_posts', {}) or database.data['help_forum_posts'][post.id]['last_eval'] < last_update:
-        contribs = {}
-        last_contrib = {}
-        async for msg in post.history(limit=None, oldest_first=True):
-          user = msg.author.id
-          if user == post.owner_id or msg.author.bot or msg.is_system() or (user in last_contrib and (msg.created_at - last_contrib[user]).total_seconds() < contrib_cooldown):
-            continue
-          try:
-            contribs[user] += 1
-          except KeyError:
-            contribs[user] = 1
-          last_contrib[user] = msg.created_at
-        database.data['help_forum_posts'][post.id] = {
-          'contribs': contribs,
-          'last_eval': now,
-        }
-
-      contribs = database.data['help_forum_posts'][post.id]['contribs']
-      total = sum(contribs.values())
-      for user, contrib in contribs.items():
-        contrib /= total
-        try:
-          database.data['help_forum_karma'][user] += contrib
-        except KeyError:
-          database.data['help_forum_karma'][user] = contrib
-
-    database.data['help_forum_karma'] = {}
-    forum = bot.get_channel(config['help_forum_channel'])
-    for post in forum.threads:
-      await eval_post(post, False)
-    async for post in forum.archived_threads(limit=None):
-      await eval_post(post, True)
-    database.should_save = True
-
-    awarded = set()
-    for user, _ in get_ranking():
-      if len(awarded) >= config['help_forum_award_count']:
-        break
-      member = bot.get_guild(config['guild']).get_member(user)
-      if member is not None:
-        awarded.add(member)
-
-    for member in bot.get_guild(config['guild']).get_role(config['help_forum_award_role']).members:
-      if member not in awarded:
-        await member.remove_roles(discord.Object(config['help_forum_award_role']))
-    for member in awarded:
-      if member.get_role(config['help_forum_award_role']) is None and config['help_forum_award_channel'] is not None:
-        announcement = f'{member.mention} właśnie wszedł w top {config["help_forum_award_count"]} najbardziej pomocnych użytkowników! Dziękujemy! ❤️'
-        await bot.get_channel(config['help_forum_award_channel']).send(announcement, allowed_mentions=discord.AllowedMentions.all())
-      await member.add_roles(discord.Object(config['help_forum_award_role']))
+    recalc_karma()
+    await award()
 
   eval.start()
+
+console.begin('help_forum')
+console.register('rescan',     None, 'rereads all changed posts and recalculates karma', lambda: asyncio.run_coroutine_threadsafe(rescan(), bot.loop).result())
+console.register('rescan_all', None, 'rereads all posts and recalculates karma',         lambda: asyncio.run_coroutine_threadsafe(rescan(force=True), bot.loop).result())
+console.end()
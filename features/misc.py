@@ -19,8 +19,8 @@ from datetime import datetime
 
 import database
 from common import config, hybrid_check, loop, parse_duration
-from features import xp
-from features.utils import check_staff
+from features import warns, xp
+from features.utils import accounts_of, check_staff, delete_soon, link_accounts, migrate_linked_users, unlink_account
 
 bot = None
 
@@ -48,6 +48,8 @@ async def setup(_bot):
   global bot
   bot = _bot
 
+  migrate_linked_users()
+
   @bot.on_check_failure
   async def on_check_failure(interaction, error):
     if isinstance(error, NoStaffError):
@@ -104,7 +106,7 @@ async def setup(_bot):
 
     logging.info(f'{interaction.user.id} has raised the alarm!')
     database.data['alarm_last'] = now
-    database.should_save = True
+    database.touch('alarm_last')
 
     staff = get_staff()
     emoji = random.choice(['😟', '😖', '😱', '😮', '😵', '😵‍💫', '🥴'])
@@ -146,7 +148,7 @@ async def setup(_bot):
   @bot.listen()
   async def on_message(msg):
     if msg.channel.id in config['media_channels'] and all(i.width is None and i.height is None for i in msg.attachments):
-      await msg.delete()
+      delete_soon(msg)
 
   @bot.tree.command(description='Łączy dwa konta tego samego użytkownika')
   @check_staff('łączenia kont')
@@ -156,16 +158,11 @@ async def setup(_bot):
       return
 
     with database.lock:
-      are_already_linked = user1.id in database.data.get('linked_users', {}).get(user2.id, [])
+      are_already_linked = not link_accounts(user1.id, user2.id)
       if not are_already_linked:
-        logging.info(f'Linking users {user1.id} and {user2.id}')
-        clique1 = database.data.setdefault('linked_users', {}).setdefault(user1.id, []) + [user1.id]
-        clique2 = database.data['linked_users'].setdefault(user2.id, []) + [user2.id]
-        for i in clique1:
-          database.data['linked_users'][i] += clique2
-        for i in clique2:
-          database.data['linked_users'][i] += clique1
-        database.should_save = True
+        logging.info(f'Linked users {user1.id} and {user2.id}')
+        warns.group_warns.clear()
+        warns.schedule_expires(user1.id)
 
     if are_already_linked:
       await interaction.response.send_message(f'Konta {user1.mention} i {user2.mention} już są ze sobą połączone… 🤨', ephemeral=True)
@@ -176,13 +173,13 @@ async def setup(_bot):
   @check_staff('odłączania kont')
   async def unlink(interaction, user: discord.User):
     with database.lock:
-      is_already_unlinked = not database.data.get('linked_users', {}).get(user.id, [])
+      others = accounts_of(user.id) - {user.id}
+      is_already_unlinked = not unlink_account(user.id)
       if not is_already_unlinked:
-        logging.info(f'Unlinking user {user.id}')
-        for i in database.data['linked_users'][user.id]:
-          database.data['linked_users'][i].remove(user.id)
-        del database.data['linked_users'][user.id]
-        database.should_save = True
+        logging.info(f'Unlinked user {user.id}')
+        warns.group_warns.clear()
+        warns.schedule_expires(user.id)
+        warns.schedule_expires(min(others))
 
     if is_already_unlinked:
       await interaction.response.send_message(f'{user.mention} nie ma żadnych innych kont… 🤨', ephemeral=True)
@@ -191,7 +188,8 @@ async def setup(_bot):
 
   @bot.tree.command(description='Wyświetla pozostałe konta użytkownika')
   async def linked(interaction, user: discord.User):
-    if not database.data.get('linked_users', {}).get(user.id, []):
+    others = sorted(accounts_of(user.id) - {user.id})
+    if not others:
       await interaction.response.send_message(f'{user.mention} nie ma żadnych innych kont. 🕵️', ephemeral=True)
     else:
-      await interaction.response.send_message(f'Do {user.mention} należą też konta: ' + ', '.join(f'<@{i}>' for i in database.data['linked_users'][user.id]) + '. 🕵️', ephemeral=True)
+      await interaction.response.send_message(f'Do {user.mention} należą też konta: ' + ', '.join(f'<@{i}>' for i in others) + '. 🕵️', ephemeral=True)
@@ -23,6 +23,8 @@ from features.warns import warns_of
 bot = None
 lock = asyncio.Lock()
 
+database.schemas['ping_role_last_use'] = database.keyed_by_int(database.as_datetime)
+
 async def setup(_bot):
   global bot
   bot = _bot
@@ -102,15 +104,18 @@ async def setup(_bot):
         )
 
         database.data.setdefault('ping_role_last_use', {})[interaction.user.id] = new_msg.created_at
+        database.touch('ping_role_last_use', interaction.user.id)
         if authorizing_rule is not None:
           match authorizing_rule['cooldown_subject']:
             case 'user':
               database.data.setdefault('ping_role_rule_last_use', {}).setdefault(authorizing_rule['id'], {})[interaction.user.id] = new_msg.created_at
+              database.touch('ping_role_rule_last_use', authorizing_rule['id'], interaction.user.id)
             case 'role':
               database.data.setdefault('ping_role_rule_last_use', {}).setdefault(authorizing_rule['id'], {})[role.id] = new_msg.created_at
+              database.touch('ping_role_rule_last_use', authorizing_rule['id'], role.id)
             case None:
               database.data.setdefault('ping_role_rule_last_use', {})[authorizing_rule['id']] = new_msg.created_at
-        database.should_save = True
+              database.touch('ping_role_rule_last_use', authorizing_rule['id'])
 
         try:
           await msg.delete()
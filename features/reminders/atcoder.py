@@ -24,6 +24,8 @@ from common import config, log_exceptions, loop, mention_datetime, parse_duratio
 
 bot = None
 
+database.schemas['atcoder_handles'] = database.keyed_by_int()
+
 @dataclass
 class Contest:
   id: str
@@ -215,7 +217,7 @@ async def setup(_bot):
     if read is not None and ''.join(read.split()) == a + b:
       logging.info(f'{interaction.user.id} has successfully set their AtCoder handle to {handle!r}')
       database.data.setdefault('atcoder_handles', {})[interaction.user.id] = handle
-      database.should_save = True
+      database.touch('atcoder_handles', interaction.user.id)
       await interaction.edit_original_response(content=f'Pomyślnie zweryfikowano i ustawiono twój nick na AtCoder na `{handle}`! 🥳\n')
     else:
       logging.info(f'{interaction.user.id} failed to verify their AtCoder handle ({read!r} != {a!r} & {b!r})')
@@ -246,7 +248,7 @@ async def setup(_bot):
   async def unset(interaction):
     try:
       del database.data['atcoder_handles'][interaction.user.id]
-      database.should_save = True
+      database.touch('atcoder_handles', interaction.user.id)
     except KeyError:
       await interaction.response.send_message('Nie podałeś mi jeszcze swojego nicku na AtCoder… 🤨', ephemeral=True)
     else:
@@ -23,6 +23,8 @@ from common import config, log_exceptions, loop, mention_datetime, parse_duratio
 
 bot = None
 
+database.schemas['codeforces_handles'] = database.keyed_by_int()
+
 @dataclass
 class Contest:
   id: int
@@ -120,7 +122,7 @@ async def send_national_standings(contest):
         continue
       logging.info(f"Updating {user}'s Codeforces handle from {old_handle!r} to {new_handle!r}")
       database.data['codeforces_handles'][user] = new_handle
-      database.should_save = True
+      database.touch('codeforces_handles', user)
 
   lines = []
 
@@ -275,7 +277,7 @@ async def setup(_bot):
     if success is not None:
       logging.info(f'{interaction.user.id} has successfully set their Codeforces handle to {handle!r}')
       database.data.setdefault('codeforces_handles', {})[interaction.user.id] = handle
-      database.should_save = True
+      database.touch('codeforces_handles', interaction.user.id)
       await interaction.edit_original_response(content=f'Pomyślnie zweryfikowano i ustawiono twój nick na Codeforces na `{handle}`! 🥳\n{success}')
     else:
       logging.info(f'{interaction.user.id} failed to verify their Codeforces handle ({first!r} & {last!r} != {a!r} & {b!r})')
@@ -306,7 +308,7 @@ async def setup(_bot):
   async def unset(interaction):
     try:
       del database.data['codeforces_handles'][interaction.user.id]
-      database.should_save = True
+      database.touch('codeforces_handles', interaction.user.id)
     except KeyError:
       await interaction.response.send_message('Nie podałeś mi jeszcze swojego nicku na Codeforces… 🤨', ephemeral=True)
     else:
@@ -102,7 +102,7 @@ async def setup(bot):
     if 'oki_last_published' not in database.data:
       logging.info("OKI's YouTube channel has never been checked before")
       database.data['oki_last_published'] = datetime.now().astimezone()
-      database.should_save = True
+      database.touch('oki_last_published')
 
     last_published = database.data['oki_last_published']
     for video in videos:
@@ -114,7 +114,7 @@ async def setup(bot):
       if not video.is_livestream:
         with database.lock:
           database.data['oki_last_published'] = max(database.data['oki_last_published'], video.time)
-          database.should_save = True
+          database.touch('oki_last_published')
 
   async def process_feed(content):
     ns = {'atom': 'http://www.w3.org/2005/Atom', 'yt': 'http://www.youtube.com/xml/schemas/2015'}
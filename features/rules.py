@@ -162,7 +162,7 @@ async def setup(bot):
       await interaction.response.send_message('Regulamin nie może zawierać linijki dłuższe niż ~2000 znaków. 😊', ephemeral=True)
       return
 
-    if sum(map(sugestie.is_pending, database.data.get('sugestie', []))) < ile_sugestii:
+    if len(sugestie.pending_sugestie()) < ile_sugestii:
       await interaction.response.send_message(f'Nie ma co najmniej **{ile_sugestii}** sugestii, które zostały jeszcze do wykonania… 🤨', ephemeral=True)
       return
 
@@ -174,7 +174,7 @@ async def setup(bot):
         'sugestie': [int(select.values[0]) for select in view.children[:-1]] if ile_sugestii > 0 else [],
       }
       database.data.setdefault('rules', []).append(rules)
-      database.should_save = True
+      database.touch('rules')
 
       if interaction.response.is_done():
         await interaction.edit_original_response(content='Pomyślnie ustanowiono nowy regulamin. 🫡', view=None)
@@ -206,7 +206,7 @@ async def setup(bot):
 
         select = discord.ui.Select()
         select.callback = callback
-        for sugestia in filter(sugestie.is_pending, reversed(database.data['sugestie'])):
+        for sugestia in sugestie.pending_sugestie():
           select.add_option(label=limit_len(sugestia['text']), value=sugestia['id'], description=format_datetime(sugestia['time']))
         view.add_item(select)
 
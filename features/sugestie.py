@@ -15,18 +15,136 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio, discord, logging
-from base64 import b64decode, b64encode
+from base64 import b64decode
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from enum import auto, Enum
+from heapq import heappop, heappush
 from io import BytesIO
 from mimetypes import guess_extension
 
 import console, database
-from common import config, debacktick, format_datetime, hybrid_check, limit_len, log_exceptions, mention_datetime, mention_message, parse_duration, select_view, sleep_until
-from features.utils import check_staff, is_staff
+from common import config, debacktick, format_datetime, hybrid_check, limit_len, log_exceptions, mention_datetime, mention_message, parse_duration, select_view
+from features.utils import check_staff, fetch_user, fetch_users, is_staff
 
 bot = None
+update_heap = [] # (time, sugestia ID) of the upcoming ends of the review and the vote
+update_wakeup = None # Created in setup, as an Event belongs to the loop it was first used in
+messages = {} # Sugestia ID -> its message as of our last edit, only for ongoing sugestie
+update_queue = set() # IDs of sugestie waiting for flush_update
+
+# Finished sugestie, that is annulled, done or rejected ones, can't change
+# anymore apart from being erased or, if rejected, annulled, so they are moved
+# from the list in database.data['sugestie'] to the dict in
+# database.data['sugestie_archive'], which with SQLite is read only on demand.
+# The IDs of the rejected ones are kept in database.data['sugestie_rejected'],
+# so that they can be annulled without going through the whole archive. What's
+# left in the list are the ongoing and pending sugestie, which are indexed here
+# by ID and status.
+positions = {} # Sugestia ID -> index in database.data['sugestie']
+positions_source = None # The database.data['sugestie'] that the index was built for
+ongoing_ids = set()
+pending_ids = set()
+
+database.schemas['sugestie_archive'] = database.keyed_by_int(database.convert)
+
+def hot():
+  global positions, positions_source
+  sugestie = database.data.setdefault('sugestie', [])
+  if positions_source is not sugestie:
+    positions_source = sugestie
+    positions = {sugestia['id']: i for i, sugestia in enumerate(sugestie)}
+    ongoing_ids.clear()
+    pending_ids.clear()
+    for sugestia in sugestie:
+      index_status(sugestia)
+  return sugestie
+
+def archived():
+  if 'sugestie_archive' not in database.data:
+    database.data['sugestie_archive'] = {}
+  return database.data['sugestie_archive']
+
+def rejected():
+  if 'sugestie_rejected' not in database.data:
+    database.data['sugestie_rejected'] = []
+  return database.data['sugestie_rejected']
+
+def archive(sugestia):
+  archived()[sugestia['id']] = sugestia
+  database.touch('sugestie_archive', sugestia['id'])
+  if is_annullable(sugestia):
+    rejected().append(sugestia['id'])
+    database.touch('sugestie_rejected', len(rejected()) - 1)
+
+def unreject(id):
+  if id in database.data.get('sugestie_rejected', []):
+    rejected().remove(id)
+    database.touch('sugestie_rejected')
+
+def index_status(sugestia):
+  for ids, pred in [(ongoing_ids, is_ongoing), (pending_ids, is_pending)]:
+    if pred(sugestia):
+      ids.add(sugestia['id'])
+    else:
+      ids.discard(sugestia['id'])
+
+def get(id):
+  sugestie = hot()
+  if id in positions:
+    return sugestie[positions[id]]
+  return database.data.get('sugestie_archive', {}).get(id)
+
+def all_sugestie():
+  # This reads the whole archive.
+  return sorted([*database.data.get('sugestie_archive', {}).values(), *hot()], key=lambda x: x['id'])
+
+def annullable_sugestie():
+  # This reads the rejected sugestie from the archive.
+  return sorted([*map(get, database.data.get('sugestie_rejected', [])), *hot()], key=lambda x: x['id'])
+
+def pending_sugestie():
+  sugestie = hot()
+  return [sugestie[positions[i]] for i in sorted(pending_ids, reverse=True)]
+
+def add(sugestia):
+  sugestie = hot()
+  positions[sugestia['id']] = len(sugestie)
+  sugestie.append(sugestia)
+  index_status(sugestia)
+  touch(sugestia)
+
+def remove(sugestia):
+  global positions_source
+  sugestie = hot()
+  if sugestia['id'] in positions:
+    del sugestie[positions[sugestia['id']]]
+    database.touch('sugestie')
+    positions_source = None
+  else:
+    del archived()[sugestia['id']]
+    database.touch('sugestie_archive', sugestia['id'])
+    unreject(sugestia['id'])
+
+def touch(sugestia):
+  global positions_source
+  sugestie = hot()
+  id = sugestia['id']
+  if id in positions and sugestie[positions[id]] is sugestia:
+    if is_finished(sugestia):
+      logging.info(f'Archiving sugestia {id}')
+      del sugestie[positions[id]]
+      database.touch('sugestie')
+      positions_source = None
+      archive(sugestia)
+    else:
+      database.touch('sugestie', positions[id])
+      index_status(sugestia)
+  elif id in database.data.get('sugestie_archive', {}):
+    database.touch('sugestie_archive', id)
+    if not is_annullable(sugestia):
+      unreject(id)
+  # Otherwise the sugestia got erased in the meantime.
 
 def is_ongoing(sugestia):
   return 'annulled' not in sugestia and 'outcome' not in sugestia
@@ -37,6 +155,9 @@ def is_pending(sugestia):
 def is_annullable(sugestia):
   return 'annulled' not in sugestia and 'done' not in sugestia
 
+def is_finished(sugestia):
+  return not is_ongoing(sugestia) and not is_pending(sugestia)
+
 def is_eraseable_in(interaction):
   return lambda sugestia: (sugestia['author'] == interaction.user.id or is_staff(interaction.user)) and 'done' not in sugestia
 
@@ -52,234 +173,302 @@ def emoji_status_of(sugestia):
   else:
     return '✅'
 
+def image_file_of(sugestia):
+  # discord.py streams the file straight from disk, so there is no need to ever
+  # load the whole image into memory.
+  filename = 'sugestia' + guess_extension(sugestia['image']['format'])
+  return discord.File(database.blob_path(sugestia['image']['blob']), filename)
+
+async def message_of(sugestia):
+  # Ongoing sugestie get edited after every vote, so their messages are kept
+  # around instead of being fetched each time.
+  msg = messages.get(sugestia['id'])
+  if msg is None:
+    msg = await bot.get_channel(sugestia['channel']).fetch_message(sugestia['id'])
+  return msg
+
+def remember_message(sugestia, msg):
+  if is_ongoing(sugestia):
+    messages[sugestia['id']] = msg
+  else:
+    messages.pop(sugestia['id'], None)
+
 async def update_embed(sugestia):
-  msg = await bot.get_channel(sugestia['channel']).fetch_message(sugestia['id'])
+  msg = await message_of(sugestia)
   embed = msg.embeds[0]
 
   embed.clear_fields()
+  users = await fetch_users(sugestia['opinions'])
   for author, opinion in sorted(sugestia['opinions'].items(), key=lambda x: x[1]['time'], reverse=True):
-    embed.add_field(name=str(await bot.fetch_user(author)).replace('_', '\\_') + ':', value=opinion['text'], inline=False)
+    embed.add_field(name=str(users[author]).replace('_', '\\_') + ':', value=opinion['text'], inline=False)
 
   if sugestia['image'] is None:
     embed.set_thumbnail(url=None)
-    await msg.edit(embed=embed, attachments=[])
+    msg = await msg.edit(embed=embed, attachments=[])
   else:
-    filename = 'sugestia' + guess_extension(sugestia['image']['format'])
-    embed.set_thumbnail(url=f'attachment://{filename}')
-    await msg.edit(embed=embed, attachments=[discord.File(BytesIO(b64decode(sugestia['image']['data'])), filename)])
+    file = image_file_of(sugestia)
+    embed.set_thumbnail(url=f'attachment://{file.filename}')
+    msg = await msg.edit(embed=embed, attachments=[file])
+  remember_message(sugestia, msg)
+
+async def on_opinion(interaction, sugestia):
+  if config['sugestie_role'] is not None and interaction.user.get_role(config['sugestie_role']) is None:
+    await interaction.response.send_message(f'Nie masz jeszcze roli <@&{config["sugestie_role"]}> i nie możesz opiniować sugestii. 😢', ephemeral=True)
+    return
+  if interaction.created_at >= sugestia['review_end']:
+    await interaction.response.send_message('Czas na opiniowanie tej sugestii już się skończył. ⏱️', ephemeral=True)
+    return
 
-def view_for(sugestia):
-  view = discord.ui.View(timeout=None)
+  async def on_submit(interaction2):
+    if config['sugestie_role'] is not None and interaction2.user.get_role(config['sugestie_role']) is None:
+      await interaction2.response.send_message(f'Nie masz jeszcze roli <@&{config["sugestie_role"]}> i nie możesz opiniować sugestii. 😢', ephemeral=True)
+    elif interaction2.created_at >= sugestia['review_end']:
+      await interaction2.response.send_message('Czas na opiniowanie tej sugestii już się skończył. ⏱️', ephemeral=True)
+    else:
+      if text_input.value == sugestia['opinions'].get(interaction2.user.id, {}).get('text'):
+        logging.info(f'{interaction2.user.id} bumped their opinion of sugestia {sugestia["id"]}')
+      else:
+        logging.info(f'{interaction2.user.id} has given their opinion of sugestia {sugestia["id"]}')
+      sugestia['opinions'][interaction2.user.id] = {
+        'text': text_input.value,
+        'time': interaction2.created_at,
+      }
+      touch(sugestia)
 
-  if sugestia.get('annulled', {}).get('time', datetime.now().astimezone()) < sugestia['review_end']:
-    async def on_opinion(interaction):
-      if config['sugestie_role'] is not None and interaction.user.get_role(config['sugestie_role']) is None:
-        await interaction.response.send_message(f'Nie masz jeszcze roli <@&{config["sugestie_role"]}> i nie możesz opiniować sugestii. 😢', ephemeral=True)
-        return
-      if interaction.created_at >= sugestia['review_end']:
-        await interaction.response.send_message('Czas na opiniowanie tej sugestii już się skończył. ⏱️', ephemeral=True)
-        return
+      await update_embed(sugestia)
 
-      async def on_submit(interaction2):
-        if config['sugestie_role'] is not None and interaction2.user.get_role(config['sugestie_role']) is None:
-          await interaction2.response.send_message(f'Nie masz jeszcze roli <@&{config["sugestie_role"]}> i nie możesz opiniować sugestii. 😢', ephemeral=True)
-        elif interaction2.created_at >= sugestia['review_end']:
-          await interaction2.response.send_message('Czas na opiniowanie tej sugestii już się skończył. ⏱️', ephemeral=True)
-        else:
-          if text_input.value == sugestia['opinions'].get(interaction2.user.id, {}).get('text'):
-            logging.info(f'{interaction2.user.id} bumped their opinion of sugestia {sugestia["id"]}')
-          else:
-            logging.info(f'{interaction2.user.id} has given their opinion of sugestia {sugestia["id"]}')
-          sugestia['opinions'][interaction2.user.id] = {
-            'text': text_input.value,
-            'time': interaction2.created_at,
-          }
-          database.should_save = True
-
-          await update_embed(sugestia)
-
-          msg = mention_message(bot, sugestia['channel'], sugestia['id'])
-          await interaction2.response.send_message(f'Pomyślnie zaopiniowano sugestię {msg}! 🥳', ephemeral=True)
-
-      text_input = discord.ui.TextInput(
-        default=sugestia['opinions'].get(interaction.user.id, {}).get('text'),
-        label='Opinia',
-        max_length=1024,
-        style=discord.TextStyle.long,
-      )
-      modal = discord.ui.Modal(title='Zaopiniuj sugestię')
-      modal.on_submit = on_submit
-      modal.add_item(text_input)
-      await interaction.response.send_modal(modal)
-
-    opinion = discord.ui.Button(custom_id='opinion', label='Zaopiniuj', style=discord.ButtonStyle.green)
-    opinion.callback = on_opinion
-    view.add_item(opinion)
-
-    async def on_delete(interaction):
       msg = mention_message(bot, sugestia['channel'], sugestia['id'])
+      await interaction2.response.send_message(f'Pomyślnie zaopiniowano sugestię {msg}! 🥳', ephemeral=True)
+
+  text_input = discord.ui.TextInput(
+    default=sugestia['opinions'].get(interaction.user.id, {}).get('text'),
+    label='Opinia',
+    max_length=1024,
+    style=discord.TextStyle.long,
+  )
+  modal = discord.ui.Modal(title='Zaopiniuj sugestię')
+  modal.on_submit = on_submit
+  modal.add_item(text_input)
+  await interaction.response.send_modal(modal)
+
+async def on_delete(interaction, sugestia):
+  msg = mention_message(bot, sugestia['channel'], sugestia['id'])
+
+  if is_staff(interaction.user):
+    if not sugestia['opinions']:
+      await interaction.response.send_message(f'Nikt jeszcze nie zaopiniował tej sugestii… 🤨', ephemeral=True)
+      return
 
-      if is_staff(interaction.user):
-        if not sugestia['opinions']:
-          await interaction.response.send_message(f'Nikt jeszcze nie zaopiniował tej sugestii… 🤨', ephemeral=True)
-          return
-
-        async def callback(interaction2, choice):
-          check_staff('usuwania opinii')(interaction2)
-          author = int(choice)
-
-          logging.info(f"{interaction.user.id} has removed {author}'s opinion of sugestia {sugestia['id']}")
-          del sugestia['opinions'][author]
-          database.should_save = True
+    async def callback(interaction2, choice):
+      check_staff('usuwania opinii')(interaction2)
+      author = int(choice)
 
-          await update_embed(sugestia)
+      logging.info(f"{interaction.user.id} has removed {author}'s opinion of sugestia {sugestia['id']}")
+      del sugestia['opinions'][author]
+      touch(sugestia)
 
-          await interaction2.response.send_message(f'Pomyślnie usunięto opinię <@{author}> o sugestii {msg}. 🙄', ephemeral=True)
+      await update_embed(sugestia)
 
-        await interaction.response.send_message('Którą opinię chcesz usunąć?', view=select_view(
-          [
-            discord.SelectOption(label=limit_len(opinion['text']), value=author, description=str(await bot.fetch_user(author)))
-            for author, opinion in reversed(sugestia['opinions'].items())
-          ],
-          callback,
-          interaction.user,
-        ), ephemeral=True)
+      await interaction2.response.send_message(f'Pomyślnie usunięto opinię <@{author}> o sugestii {msg}. 🙄', ephemeral=True)
 
-      else:
-        if interaction.user.id not in sugestia['opinions']:
-          await interaction.response.send_message(f'Nie zaopiniowałeś jeszcze tej sugestii… 🤨', ephemeral=True)
-          return
+    users = await fetch_users(sugestia['opinions'])
+    await interaction.response.send_message('Którą opinię chcesz usunąć?', view=select_view(
+      [
+        discord.SelectOption(label=limit_len(opinion['text']), value=author, description=str(users[author]))
+        for author, opinion in reversed(sugestia['opinions'].items())
+      ],
+      callback,
+      interaction.user,
+    ), ephemeral=True)
 
-        logging.info(f'{interaction.user.id} has removed their opinion of sugestia {sugestia["id"]}')
-        del sugestia['opinions'][interaction.user.id]
-        database.should_save = True
+  else:
+    if interaction.user.id not in sugestia['opinions']:
+      await interaction.response.send_message(f'Nie zaopiniowałeś jeszcze tej sugestii… 🤨', ephemeral=True)
+      return
 
-        await update_embed(sugestia)
+    logging.info(f'{interaction.user.id} has removed their opinion of sugestia {sugestia["id"]}')
+    del sugestia['opinions'][interaction.user.id]
+    touch(sugestia)
 
-        await interaction.response.send_message(f'Pomyślnie usunięto twoją opinię o sugestii {msg}. 🫡', ephemeral=True)
+    await update_embed(sugestia)
 
-    delete = discord.ui.Button(custom_id='delete', label='Usuń opinię', style=discord.ButtonStyle.red)
-    delete.callback = on_delete
-    view.add_item(delete)
+    await interaction.response.send_message(f'Pomyślnie usunięto twoją opinię o sugestii {msg}. 🫡', ephemeral=True)
 
-    if 'annulled' in sugestia:
-      for button in view.children:
-        button.disabled = True
+async def on_vote(interaction, sugestia, choice):
+  user = interaction.user.id
 
+  if config['sugestie_role'] is not None and interaction.user.get_role(config['sugestie_role']) is None:
+    await interaction.response.send_message(f'Nie masz jeszcze roli <@&{config["sugestie_role"]}> i nie możesz głosować nad sugestiami. 😢', ephemeral=True)
+  elif interaction.created_at < sugestia['review_end']:
+    await interaction.response.send_message('Głosowanie nad tą sugestią jeszcze się nie zaczęło. ⏱️', ephemeral=True)
+  elif interaction.created_at >= sugestia['vote_end']:
+    await interaction.response.send_message('Głosowanie nad tą sugestią już się skończyło. ⏱️', ephemeral=True)
+  elif user in sugestia[choice]:
+    await interaction.response.send_message('Już zagłosowałeś na tę opcję… 😐', ephemeral=True)
   else:
-    view.add_item(discord.ui.Button(custom_id='for', label=f'Za ({len(sugestia["for"])})', style=discord.ButtonStyle.green))
-    view.add_item(discord.ui.Button(custom_id='abstain', label=f'Nie wiem ({len(sugestia["abstain"])})', style=discord.ButtonStyle.gray))
-    view.add_item(discord.ui.Button(custom_id='against', label=f'Przeciw ({len(sugestia["against"])})', style=discord.ButtonStyle.red))
-
-    # This breaks on sugestia deletion or when the sugestia object in database.data changes, e.g. after database.load. There may be other such edge cases in the codebase.
-    async def on_vote(interaction):
-      user = interaction.user.id
-      choice = interaction.data['custom_id']
-
-      if config['sugestie_role'] is not None and interaction.user.get_role(config['sugestie_role']) is None:
-        await interaction.response.send_message(f'Nie masz jeszcze roli <@&{config["sugestie_role"]}> i nie możesz głosować nad sugestiami. 😢', ephemeral=True)
-      elif interaction.created_at < sugestia['review_end']:
-        await interaction.response.send_message('Głosowanie nad tą sugestią jeszcze się nie zaczęło. ⏱️', ephemeral=True)
-      elif interaction.created_at >= sugestia['vote_end']:
-        await interaction.response.send_message('Głosowanie nad tą sugestią już się skończyło. ⏱️', ephemeral=True)
-      elif user in sugestia[choice]:
-        await interaction.response.send_message('Już zagłosowałeś na tę opcję… 😐', ephemeral=True)
-      else:
-        with database.lock:
-          is_change_of_mind = False
-          for i in ['for', 'abstain', 'against']:
-            if user in sugestia[i]:
-              is_change_of_mind = True
-              sugestia[i].remove(user)
-          sugestia[choice].add(user)
-          database.should_save = True
-
-        if is_change_of_mind:
-          logging.info(f'{user} has changed their vote to {choice!r} on sugestia {sugestia["id"]}')
-          replies = {
-            'for': 'Pomyślnie zmieniono głos na **za** sugestią. 🫡',
-            'abstain': 'Pomyślnie zmieniono głos na **wstrzymanie się** od głosu. 🫡',
-            'against': 'Pomyślnie zmieniono głos na **przeciw** sugestii. 🫡',
-          }
-        else:
-          logging.info(f'{user} has voted {choice!r} on sugestia {sugestia["id"]}')
-          replies = {
-            'for': 'Pomyślnie zagłosowano **za** sugestią. 🫡',
-            'abstain': 'Pomyślnie **wstrzymano się** od głosu. 🫡',
-            'against': 'Pomyślnie zagłosowano **przeciw** sugestii. 🫡',
-          }
-        await interaction.response.send_message(replies[choice], ephemeral=True)
-
-      await update(sugestia)
-
-    if is_ongoing(sugestia):
-      for button in view.children:
-        button.callback = on_vote
+    with database.lock:
+      is_change_of_mind = False
+      for i in ['for', 'abstain', 'against']:
+        if user in sugestia[i]:
+          is_change_of_mind = True
+          sugestia[i].remove(user)
+      sugestia[choice].add(user)
+      touch(sugestia)
+
+    if is_change_of_mind:
+      logging.info(f'{user} has changed their vote to {choice!r} on sugestia {sugestia["id"]}')
+      replies = {
+        'for': 'Pomyślnie zmieniono głos na **za** sugestią. 🫡',
+        'abstain': 'Pomyślnie zmieniono głos na **wstrzymanie się** od głosu. 🫡',
+        'against': 'Pomyślnie zmieniono głos na **przeciw** sugestii. 🫡',
+      }
     else:
-      for button in view.children:
-        button.disabled = True
+      logging.info(f'{user} has voted {choice!r} on sugestia {sugestia["id"]}')
+      replies = {
+        'for': 'Pomyślnie zagłosowano **za** sugestią. 🫡',
+        'abstain': 'Pomyślnie **wstrzymano się** od głosu. 🫡',
+        'against': 'Pomyślnie zagłosowano **przeciw** sugestii. 🫡',
+      }
+    await interaction.response.send_message(replies[choice], ephemeral=True)
 
-  async def on_describe(interaction):
-    url = mention_message(bot, sugestia['channel'], sugestia['id'])
-    result = f'## Sugestia {url}\n'
+  update_soon(sugestia)
 
-    if sugestia.get('annulled', {}).get('time', datetime.now().astimezone()) < sugestia['review_end']:
-      review_end = mention_datetime(sugestia['review_end'])
-      if 'annulled' in sugestia:
-        result += f'Opiniowanie miało skończyć się {review_end}. \n'
-      else:
-        result += f'**Opiniowanie jeszcze trwa** i skończy się {review_end}. ❔\n'
+async def on_describe(interaction, sugestia):
+  url = mention_message(bot, sugestia['channel'], sugestia['id'])
+  result = f'## Sugestia {url}\n'
 
+  if sugestia.get('annulled', {}).get('time', datetime.now().astimezone()) < sugestia['review_end']:
+    review_end = mention_datetime(sugestia['review_end'])
+    if 'annulled' in sugestia:
+      result += f'Opiniowanie miało skończyć się {review_end}. \n'
     else:
-      vote_end = mention_datetime(sugestia['vote_end'])
-      if 'outcome' in sugestia:
-        result += f'Głosowanie zakończyło się {vote_end} wynikiem '
-        if sugestia['outcome']:
-          result += '**pozytywnym**. ✅\n'
-        else:
-          result += '**negatywnym**. ❌\n'
-      elif 'annulled' in sugestia:
-        result += f'Głosowanie miało skończyć się {vote_end}.\n'
-      else:
-        result += f'**Głosowanie jeszcze trwa** i skończy się {vote_end}. ❔\n'
+      result += f'**Opiniowanie jeszcze trwa** i skończy się {review_end}. ❔\n'
 
-      if sugestia['for']:
-        voters = ', '.join(f'<@{i}>' for i in sugestia['for'])
-        result += f'- Głosowali **za**: {voters}\n'
-      else:
-        result += '- **Nikt** nie głosował **za**.\n'
-
-      if sugestia['abstain']:
-        voters = ', '.join(f'<@{i}>' for i in sugestia['abstain'])
-        result += f'- **Wstrzymali się** od głosu: {voters}\n'
+  else:
+    vote_end = mention_datetime(sugestia['vote_end'])
+    if 'outcome' in sugestia:
+      result += f'Głosowanie zakończyło się {vote_end} wynikiem '
+      if sugestia['outcome']:
+        result += '**pozytywnym**. ✅\n'
       else:
-        result += '- **Nikt** nie **wstrzymał się** od głosu.\n'
+        result += '**negatywnym**. ❌\n'
+    elif 'annulled' in sugestia:
+      result += f'Głosowanie miało skończyć się {vote_end}.\n'
+    else:
+      result += f'**Głosowanie jeszcze trwa** i skończy się {vote_end}. ❔\n'
 
-      if sugestia['against']:
-        voters = ', '.join(f'<@{i}>' for i in sugestia['against'])
-        result += f'- Głosowali **przeciw**: {voters}\n'
-      else:
-        result += '- **Nikt** nie głosował **przeciw**.\n'
+    if sugestia['for']:
+      voters = ', '.join(f'<@{i}>' for i in sugestia['for'])
+      result += f'- Głosowali **za**: {voters}\n'
+    else:
+      result += '- **Nikt** nie głosował **za**.\n'
 
-    if 'annulled' in sugestia:
-      time = mention_datetime(sugestia['annulled']['time'])
-      reason = debacktick(sugestia['annulled']['reason'])
-      result += f'Sugestia **została unieważniona** {time} z powodu `{reason}`. 🚯\n'
-    elif sugestia.get('outcome', False):
-      if 'done' in sugestia:
-        time = mention_datetime(sugestia['done']['time'])
-        changes = debacktick(sugestia['done']['changes'])
-        result += f'Sugestia **została wykonana** {time} z opisem zmian `{changes}` ✅\n'
-      else:
-        result += 'Sugestia **nie została jeszcze wykonana** przez administrację. ❓\n'
+    if sugestia['abstain']:
+      voters = ', '.join(f'<@{i}>' for i in sugestia['abstain'])
+      result += f'- **Wstrzymali się** od głosu: {voters}\n'
+    else:
+      result += '- **Nikt** nie **wstrzymał się** od głosu.\n'
 
-    msg = await interaction.user.send(result)
-    await interaction.response.send_message(f'Więcej informacji o sugestii zostało przesłane Ci w [wiadomości prywatnej]({msg.jump_url}). 😊', ephemeral=True)
+    if sugestia['against']:
+      voters = ', '.join(f'<@{i}>' for i in sugestia['against'])
+      result += f'- Głosowali **przeciw**: {voters}\n'
+    else:
+      result += '- **Nikt** nie głosował **przeciw**.\n'
 
-  describe_button = discord.ui.Button(custom_id='describe', label='Więcej informacji', style=discord.ButtonStyle.blurple)
-  describe_button.callback = on_describe
-  view.add_item(describe_button)
+  if 'annulled' in sugestia:
+    time = mention_datetime(sugestia['annulled']['time'])
+    reason = debacktick(sugestia['annulled']['reason'])
+    result += f'Sugestia **została unieważniona** {time} z powodu `{reason}`. 🚯\n'
+  elif sugestia.get('outcome', False):
+    if 'done' in sugestia:
+      time = mention_datetime(sugestia['done']['time'])
+      changes = debacktick(sugestia['done']['changes'])
+      result += f'Sugestia **została wykonana** {time} z opisem zmian `{changes}` ✅\n'
+    else:
+      result += 'Sugestia **nie została jeszcze wykonana** przez administrację. ❓\n'
+
+  msg = await interaction.user.send(result)
+  await interaction.response.send_message(f'Więcej informacji o sugestii zostało przesłane Ci w [wiadomości prywatnej]({msg.jump_url}). 😊', ephemeral=True)
+
+# The buttons carry the ID of their sugestia in their custom IDs, so one
+# handler per kind of button serves all of them and looks the sugestia up only
+# when clicked. Messages from before that have just the kind as the custom ID,
+# but the buttons are always on the message of the sugestia anyway.
+def sugestia_of(interaction, match):
+  return get(int(match['id'] or interaction.message.id))
+
+class MissingSugestia(discord.ui.DynamicItem[discord.ui.Button], template=r'.*'):
+  # Takes the place of any button of a sugestia that has been erased. It's not
+  # registered itself, the other buttons fall back to it in from_custom_id.
+  async def callback(self, interaction):
+    await interaction.response.send_message('Ta sugestia została usunięta… 🤨', ephemeral=True)
+
+class OpinionButton(discord.ui.DynamicItem[discord.ui.Button], template=r'(?:sugestia:(?P<id>[0-9]+):)?opinion'):
+  def __init__(self, sugestia, **kwargs):
+    super().__init__(discord.ui.Button(custom_id=f'sugestia:{sugestia["id"]}:opinion', label='Zaopiniuj', style=discord.ButtonStyle.green, **kwargs))
+    self.sugestia = sugestia
+
+  @classmethod
+  async def from_custom_id(cls, interaction, item, match):
+    sugestia = sugestia_of(interaction, match)
+    return cls(sugestia) if sugestia is not None else MissingSugestia(item)
+
+  async def callback(self, interaction):
+    await on_opinion(interaction, self.sugestia)
+
+class DeleteOpinionButton(discord.ui.DynamicItem[discord.ui.Button], template=r'(?:sugestia:(?P<id>[0-9]+):)?delete'):
+  def __init__(self, sugestia, **kwargs):
+    super().__init__(discord.ui.Button(custom_id=f'sugestia:{sugestia["id"]}:delete', label='Usuń opinię', style=discord.ButtonStyle.red, **kwargs))
+    self.sugestia = sugestia
+
+  @classmethod
+  async def from_custom_id(cls, interaction, item, match):
+    sugestia = sugestia_of(interaction, match)
+    return cls(sugestia) if sugestia is not None else MissingSugestia(item)
+
+  async def callback(self, interaction):
+    await on_delete(interaction, self.sugestia)
+
+class VoteButton(discord.ui.DynamicItem[discord.ui.Button], template=r'(?:sugestia:(?P<id>[0-9]+):)?(?P<choice>for|abstain|against)'):
+  labels = {'for': 'Za', 'abstain': 'Nie wiem', 'against': 'Przeciw'}
+  styles = {'for': discord.ButtonStyle.green, 'abstain': discord.ButtonStyle.gray, 'against': discord.ButtonStyle.red}
+
+  def __init__(self, sugestia, choice, **kwargs):
+    label = f'{self.labels[choice]} ({len(sugestia[choice])})'
+    super().__init__(discord.ui.Button(custom_id=f'sugestia:{sugestia["id"]}:{choice}', label=label, style=self.styles[choice], **kwargs))
+    self.sugestia = sugestia
+    self.choice = choice
+
+  @classmethod
+  async def from_custom_id(cls, interaction, item, match):
+    sugestia = sugestia_of(interaction, match)
+    return cls(sugestia, match['choice']) if sugestia is not None else MissingSugestia(item)
+
+  async def callback(self, interaction):
+    await on_vote(interaction, self.sugestia, self.choice)
+
+class DescribeButton(discord.ui.DynamicItem[discord.ui.Button], template=r'(?:sugestia:(?P<id>[0-9]+):)?describe'):
+  def __init__(self, sugestia, **kwargs):
+    super().__init__(discord.ui.Button(custom_id=f'sugestia:{sugestia["id"]}:describe', label='Więcej informacji', style=discord.ButtonStyle.blurple, **kwargs))
+    self.sugestia = sugestia
+
+  @classmethod
+  async def from_custom_id(cls, interaction, item, match):
+    sugestia = sugestia_of(interaction, match)
+    return cls(sugestia) if sugestia is not None else MissingSugestia(item)
+
+  async def callback(self, interaction):
+    await on_describe(interaction, self.sugestia)
 
+def view_for(sugestia):
+  view = discord.ui.View(timeout=None)
+  if sugestia.get('annulled', {}).get('time', datetime.now().astimezone()) < sugestia['review_end']:
+    view.add_item(OpinionButton(sugestia, disabled='annulled' in sugestia))
+    view.add_item(DeleteOpinionButton(sugestia, disabled='annulled' in sugestia))
+  else:
+    for choice in ['for', 'abstain', 'against']:
+      view.add_item(VoteButton(sugestia, choice, disabled=not is_ongoing(sugestia)))
+  view.add_item(DescribeButton(sugestia))
   return view
 
 async def update(sugestia):
@@ -289,7 +478,7 @@ async def update(sugestia):
     with database.lock:
       if datetime.now().astimezone() >= sugestia['vote_end']:
         sugestia['outcome'] = len(sugestia['for']) > len(sugestia['against'])
-        database.should_save = True
+        touch(sugestia)
 
         if sugestia['outcome']:
           logging.info(f'Sugestia {sugestia["id"]} has passed')
@@ -297,14 +486,20 @@ async def update(sugestia):
           logging.info(f'Sugestia {sugestia["id"]} did not pass')
 
   try:
-    msg = await bot.get_channel(sugestia['channel']).fetch_message(sugestia['id'])
+    msg = await message_of(sugestia)
   except discord.errors.NotFound:
     logging.warn(f'Sugestia {sugestia["id"]} is missing')
     return
 
   buttonc_before = sum(len(i.children) for i in msg.components)
 
-  await msg.edit(view=view_for(sugestia))
+  try:
+    msg = await msg.edit(view=view_for(sugestia))
+  except discord.errors.NotFound:
+    logging.warn(f'Sugestia {sugestia["id"]} is missing')
+    messages.pop(sugestia['id'], None)
+    return
+  remember_message(sugestia, msg)
 
   if is_ongoing(sugestia):
     if buttonc_before < 3 and datetime.now().astimezone() < sugestia['review_end']:
@@ -314,17 +509,54 @@ async def update(sugestia):
       if config['sugestie_vote_ping_role'] is not None:
         await (await msg.channel.send(f'<@&{config["sugestie_vote_ping_role"]}>', allowed_mentions=discord.AllowedMentions.all())).delete()
 
-@log_exceptions
-async def time_updates(sugestia):
-  time = sugestia['review_end'] + timedelta(seconds=5) # 5 seconds to make sure the if passes.
-  logging.info(f'Waiting until {time} to update sugestia {sugestia["id"]}')
-  await sleep_until(time)
-  await update(sugestia)
-
-  time = sugestia['vote_end'] + timedelta(seconds=5) # 5 seconds to make sure the if passes.
-  logging.info(f'Waiting until {time} to update sugestia {sugestia["id"]}')
-  await sleep_until(time)
-  await update(sugestia)
+def update_soon(sugestia):
+  # Votes come in bursts, so they are gathered for a moment and the message
+  # gets edited once for all of them.
+  if sugestia['id'] not in update_queue:
+    update_queue.add(sugestia['id'])
+    asyncio.create_task(log_exceptions(flush_update)(sugestia['id']))
+
+async def flush_update(id):
+  await asyncio.sleep(parse_duration(config['sugestie_edit_delay']))
+  update_queue.discard(id)
+  if (sugestia := get(id)) is not None:
+    await update(sugestia)
+
+def schedule_updates(sugestia):
+  if not is_ongoing(sugestia):
+    return
+  # 5 seconds to make sure the ifs in update pass.
+  review_end = sugestia['review_end'] + timedelta(seconds=5)
+  vote_end = sugestia['vote_end'] + timedelta(seconds=5)
+  if datetime.now().astimezone() < vote_end: # Otherwise one update is enough to catch up.
+    logging.info(f'Scheduling an update of sugestia {sugestia["id"]} for {review_end}')
+    heappush(update_heap, (review_end, sugestia['id']))
+  logging.info(f'Scheduling an update of sugestia {sugestia["id"]} for {vote_end}')
+  heappush(update_heap, (vote_end, sugestia['id']))
+  update_wakeup.set()
+
+def schedule_all_updates():
+  update_heap.clear()
+  for sugestia in hot():
+    schedule_updates(sugestia)
+
+async def update_timer():
+  # One task sleeps until the nearest scheduled update instead of every
+  # sugestia waiting on its own.
+  while True:
+    timeout = (update_heap[0][0] - datetime.now().astimezone()).total_seconds() if update_heap else None
+    try:
+      await asyncio.wait_for(update_wakeup.wait(), timeout)
+    except asyncio.TimeoutError:
+      pass
+    update_wakeup.clear()
+
+    now = datetime.now().astimezone()
+    while update_heap and update_heap[0][0] <= now:
+      _, id = heappop(update_heap)
+      sugestia = get(id)
+      if sugestia is not None and is_ongoing(sugestia): # It may have been erased or annulled in the meantime.
+        asyncio.create_task(log_exceptions(update)(sugestia))
 
 cleaning_lock = asyncio.Lock()
 async def clean():
@@ -334,7 +566,7 @@ async def clean():
   if 'sugestie_clean_until' not in database.data:
     logging.info('#sugestie has never been cleaned before')
     database.data['sugestie_clean_until'] = datetime.now().astimezone()
-    database.should_save = True
+    database.touch('sugestie_clean_until')
 
   async with cleaning_lock:
     async for msg in bot.get_channel(config['sugestie_channel']).history(limit=None, after=database.data['sugestie_clean_until']):
@@ -363,12 +595,13 @@ async def clean():
         my_msg = await msg.channel.send(embed=embed, file=discord.File(BytesIO(image), filename))
 
       logging.info(f'{msg.author.id} created sugestia {my_msg.id}')
+      blob = await asyncio.to_thread(database.put_blob, image) if image is not None else None
       sugestia = {
         'id': my_msg.id,
         'channel': my_msg.channel.id,
         'text': msg.content,
         'image': {
-          'data': b64encode(image).decode(),
+          'blob': blob,
           'format': image_format,
         } if image is not None else None,
         'time': my_msg.created_at,
@@ -380,12 +613,12 @@ async def clean():
         'against': set(),
         'vote_end': my_msg.created_at + timedelta(seconds=parse_duration(config['sugestie_review_length']) + parse_duration(config['sugestie_vote_length'])),
       }
-      database.data.setdefault('sugestie', []).append(sugestia)
+      add(sugestia)
       database.data['sugestie_clean_until'] = msg.created_at
-      database.should_save = True
+      database.touch('sugestie_clean_until')
 
       await update(sugestia)
-      asyncio.create_task(time_updates(sugestia))
+      schedule_updates(sugestia)
 
 @dataclass
 class NoSugestieError(discord.app_commands.CheckFailure):
@@ -398,28 +631,41 @@ class NoSugestieError(discord.app_commands.CheckFailure):
 
 @hybrid_check()
 def check_any(interaction):
-  if not database.data.get('sugestie', []):
+  if not hot() and not database.data.get('sugestie_archive'):
     raise NoSugestieError(NoSugestieError.Filter.Any)
 
 @hybrid_check()
 def check_pending(interaction):
-  if not any(map(is_pending, database.data.get('sugestie', []))):
+  if not pending_sugestie():
     raise NoSugestieError(NoSugestieError.Filter.Pending)
 
 @hybrid_check()
 def check_annullable(interaction):
-  if not any(map(is_annullable, database.data.get('sugestie', []))):
+  if not hot() and not database.data.get('sugestie_rejected'):
     raise NoSugestieError(NoSugestieError.Filter.Annullable)
 
 @hybrid_check()
 def check_eraseable(interaction):
-  if not any(map(is_eraseable_in(interaction), database.data.get('sugestie', []))):
+  if not any(map(is_eraseable_in(interaction), hot())) and not any(map(is_eraseable_in(interaction), database.data.get('sugestie_archive', {}).values())):
     raise NoSugestieError(NoSugestieError.Filter.Eraseable)
 
 async def setup(_bot):
   global bot
   bot = _bot
 
+  # The console can restart the bot in a new event loop, which doesn't run the
+  # tasks and can't use the messages of the previous one.
+  global update_wakeup
+  update_wakeup = asyncio.Event()
+  update_heap.clear()
+  update_queue.clear()
+  messages.clear()
+
+  migrate_archive()
+  migrate_images()
+  asyncio.create_task(log_exceptions(update_timer)())
+  bot.add_dynamic_items(OpinionButton, DeleteOpinionButton, VoteButton, DescribeButton)
+
   @bot.on_check_failure
   async def on_check_failure(interaction, error):
     if isinstance(error, NoSugestieError):
@@ -440,10 +686,7 @@ async def setup(_bot):
     logging.info('Cleaning #sugestie')
     await clean()
 
-    for sugestia in database.data.get('sugestie', []):
-      bot.add_view(view_for(sugestia), message_id=sugestia['id'])
-      if is_ongoing(sugestia):
-        asyncio.create_task(time_updates(sugestia))
+    schedule_all_updates()
 
     logging.info('Sugestie is ready')
 
@@ -460,16 +703,16 @@ async def setup(_bot):
   @check_any
   async def show(interaction):
     async def callback(interaction2, choice):
-      sugestia = next(i for i in database.data['sugestie'] if i['id'] == int(choice))
+      sugestia = get(int(choice))
       embed = discord.Embed(title='Sugestia ' + mention_message(bot, sugestia['channel'], sugestia['id']), description=sugestia['text'])
-      author = await bot.fetch_user(sugestia['author'])
+      author = await fetch_user(sugestia['author'])
       embed.set_footer(text=str(author), icon_url=author.display_avatar.url)
       if sugestia['image'] is None:
         await interaction2.response.send_message(embed=embed, ephemeral=True)
       else:
-        filename = 'sugestia' + guess_extension(sugestia['image']['format'])
-        embed.set_image(url=f'attachment://{filename}')
-        await interaction2.response.send_message(embed=embed, file=discord.File(BytesIO(b64decode(sugestia['image']['data'])), filename), ephemeral=True)
+        file = image_file_of(sugestia)
+        embed.set_image(url=f'attachment://{file.filename}')
+        await interaction2.response.send_message(embed=embed, file=file, ephemeral=True)
 
     await interaction.response.send_message('Którą sugestię chcesz zobaczyć?', view=select_view(
       [
@@ -479,7 +722,7 @@ async def setup(_bot):
           description=format_datetime(sugestia['time']),
           emoji=emoji_status_of(sugestia),
         )
-        for sugestia in reversed(database.data['sugestie'])
+        for sugestia in reversed(all_sugestie())
       ],
       callback,
       interaction.user,
@@ -489,16 +732,16 @@ async def setup(_bot):
   @check_pending
   async def pending(interaction):
     async def callback(interaction2, choice):
-      sugestia = next(i for i in database.data['sugestie'] if i['id'] == int(choice))
+      sugestia = get(int(choice))
       embed = discord.Embed(title='Sugestia ' + mention_message(bot, sugestia['channel'], sugestia['id']), description=sugestia['text'])
-      author = await bot.fetch_user(sugestia['author'])
+      author = await fetch_user(sugestia['author'])
       embed.set_footer(text=str(author), icon_url=author.display_avatar.url)
       if sugestia['image'] is None:
         await interaction2.response.send_message(embed=embed, ephemeral=True)
       else:
-        filename = 'sugestia' + guess_extension(sugestia['image']['format'])
-        embed.set_image(url=f'attachment://{filename}')
-        await interaction2.response.send_message(embed=embed, file=discord.File(BytesIO(b64decode(sugestia['image']['data'])), filename), ephemeral=True)
+        file = image_file_of(sugestia)
+        embed.set_image(url=f'attachment://{file.filename}')
+        await interaction2.response.send_message(embed=embed, file=file, ephemeral=True)
 
     await interaction.response.send_message('Którą sugestię chcesz zobaczyć?', view=select_view(
       [
@@ -508,7 +751,7 @@ async def setup(_bot):
           description=format_datetime(sugestia['time']),
           emoji=emoji_status_of(sugestia),
         )
-        for sugestia in filter(is_pending, reversed(database.data['sugestie']))
+        for sugestia in pending_sugestie()
       ],
       callback,
       interaction.user,
@@ -519,14 +762,16 @@ async def setup(_bot):
   @check_staff('wykonywania sugestii')
   async def done(interaction, changes: str):
     async def callback(interaction2, choice):
-      sugestia = next(i for i in filter(is_pending, database.data['sugestie']) if i['id'] == int(choice))
+      sugestia = get(int(choice))
+      if sugestia is None or not is_pending(sugestia): # Someone else was faster.
+        return
 
       logging.info(f'{interaction2.user.id} has marked sugestia {sugestia["id"]} as done')
       sugestia['done'] = {
         'time': interaction2.created_at,
         'changes': changes,
       }
-      database.should_save = True
+      touch(sugestia)
 
       msg = mention_message(bot, sugestia['channel'], sugestia['id'])
       await interaction.edit_original_response(content=f'Pomyślnie oznaczono sugestię {msg} jako wykonaną z opisem zmian `{debacktick(changes)}`! 🥳', view=None)
@@ -539,7 +784,7 @@ async def setup(_bot):
           value=sugestia['id'],
           description=format_datetime(sugestia['time']),
         )
-        for sugestia in filter(is_pending, reversed(database.data['sugestie']))
+        for sugestia in pending_sugestie()
       ],
       callback,
       interaction.user,
@@ -550,14 +795,16 @@ async def setup(_bot):
   @check_staff('unieważniania sugestii')
   async def annul(interaction, reason: str):
     async def callback(interaction2, choice):
-      sugestia = next(i for i in filter(is_annullable, database.data['sugestie']) if i['id'] == int(choice))
+      sugestia = get(int(choice))
+      if sugestia is None or not is_annullable(sugestia): # Someone else was faster.
+        return
 
       logging.info(f'{interaction2.user.id} has annulled sugestia {sugestia["id"]}')
       sugestia['annulled'] = {
         'time': interaction2.created_at,
         'reason': reason,
       }
-      database.should_save = True
+      touch(sugestia)
 
       msg = mention_message(bot, sugestia['channel'], sugestia['id'])
       await interaction.edit_original_response(content=f'Pomyślnie unieważniono sugestię {msg} z powodu `{debacktick(reason)}`. 🙄', view=None)
@@ -573,7 +820,7 @@ async def setup(_bot):
           description=format_datetime(sugestia['time']),
           emoji=emoji_status_of(sugestia),
         )
-        for sugestia in filter(is_annullable, reversed(database.data['sugestie']))
+        for sugestia in reversed(annullable_sugestie())
       ],
       callback,
       interaction.user,
@@ -583,11 +830,12 @@ async def setup(_bot):
   @check_eraseable
   async def erase(interaction):
     async def callback(interaction2, choice):
-      sugestia = next(i for i in filter(is_eraseable_in(interaction2), database.data['sugestie']) if i['id'] == int(choice))
+      sugestia = get(int(choice))
+      if sugestia is None or not is_eraseable_in(interaction2)(sugestia): # Someone else was faster.
+        return
 
       logging.info(f'{interaction2.user.id} has erased sugestia {sugestia["id"]}')
-      database.data['sugestie'].remove(sugestia)
-      database.should_save = True
+      remove(sugestia)
 
       try:
         await bot.get_channel(sugestia['channel']).get_partial_message(sugestia['id']).delete()
@@ -597,6 +845,8 @@ async def setup(_bot):
       await interaction.edit_original_response(content=f'Pomyślnie usunięto sugestię o treści `{limit_len(debacktick(sugestia["text"]))}`. 🙄', view=None)
       await interaction2.response.defer()
 
+      await forget_image(sugestia['image'])
+
     await interaction.response.send_message(f'Którą sugestię chcesz usunąć?', view=select_view(
       [
         discord.SelectOption(
@@ -605,7 +855,7 @@ async def setup(_bot):
           description=format_datetime(sugestia['time']),
           emoji=emoji_status_of(sugestia),
         )
-        for sugestia in filter(is_eraseable_in(interaction), reversed(database.data['sugestie']))
+        for sugestia in filter(is_eraseable_in(interaction), reversed(all_sugestie()))
       ],
       callback,
       interaction.user,
@@ -613,19 +863,61 @@ async def setup(_bot):
 
 async def fix_all(from_id):
   logging.info(f'Updating all sugestie starting from {from_id}')
-  for sugestia in database.data.get('sugestie', []):
+  for sugestia in all_sugestie():
     if sugestia['id'] >= from_id:
       await update(sugestia)
       await update_embed(sugestia)
 
 async def delete_image(id):
   logging.info(f'Deleting image from sugestia {id}')
-  sugestia = next(i for i in database.data['sugestie'] if i['id'] == id)
+  sugestia = get(id)
+  image = sugestia['image']
   sugestia['image'] = None
-  database.should_save = True
+  touch(sugestia)
   await update_embed(sugestia)
+  await forget_image(image)
+
+async def forget_image(image):
+  # Identical images share a blob. It's deleted only after the change is saved,
+  # so that a crash can't leave the database pointing at a missing file.
+  blob = image and image.get('blob')
+  if blob is not None and not any(i['image'] is not None and i['image'].get('blob') == blob for i in all_sugestie()):
+    await asyncio.to_thread(database.save)
+    await asyncio.to_thread(database.delete_blob, blob)
+
+def migrate_archive():
+  # Finished sugestie used to stay in the list forever.
+  sugestie = database.data.get('sugestie', [])
+  finished = [i for i in sugestie if is_finished(i)]
+  if finished:
+    logging.info(f'Archiving {len(finished)} finished sugestie')
+    for sugestia in finished:
+      archive(sugestia)
+    database.data['sugestie'] = [i for i in sugestie if not is_finished(i)]
+
+def migrate_images(force=False):
+  # Sugestie used to keep their images base64-encoded in the database itself.
+  # Finding them means reading the whole archive, so it's done only once.
+  if database.data.get('sugestie_images_migrated') and not force:
+    return 0
+  count = 0
+  with database.lock:
+    for sugestia in all_sugestie():
+      if sugestia['image'] is not None and 'data' in sugestia['image']:
+        sugestia['image'] = {
+          'blob': database.put_blob(b64decode(sugestia['image']['data'])),
+          'format': sugestia['image']['format'],
+        }
+        count += 1
+    if count > 0:
+      logging.info(f'Moved images of {count} sugestie to the blob store')
+      database.should_save = True # Rewriting the whole file is the whole point here.
+    database.data['sugestie_images_migrated'] = True
+    database.touch('sugestie_images_migrated')
+  return count
 
 console.begin('sugestie')
 console.register('fix_all', '<id>', 'fixes all sugestie starting from the given one', lambda x: asyncio.run_coroutine_threadsafe(fix_all(int(x)), bot.loop).result())
 console.register('delete_image', '<id>', 'deletes the image from a sugestia', lambda x: asyncio.run_coroutine_threadsafe(delete_image(int(x)), bot.loop).result())
+console.register('migrate_images', None, 'moves images still kept in the database to the blob store', lambda: migrate_images(force=True))
 console.end()
@@ -14,10 +14,26 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import discord
+import asyncio, discord, logging, time
+from collections import OrderedDict
 from dataclasses import dataclass
+from datetime import timedelta
 
-from common import config, hybrid_check
+import console, database
+from common import config, hybrid_check, log_exceptions, parse_duration
+
+bot = None
+deletion_queues = {} # Channel ID -> messages waiting for flush_deletions
+user_cache = OrderedDict() # User ID -> (user, time of fetching), least recently used first
+user_cache_stats = {'gateway': 0, 'hits': 0, 'misses': 0}
+
+database.schemas['linked_accounts'] = database.keyed_by_int()
+
+# Linked accounts form disjoint sets, which are stored as a pointer to the
+# parent of every account that isn't the root of its set. The members of each
+# set are derived from that on first use.
+account_groups = {} # Root -> accounts
+account_groups_source = None # The database.data['linked_accounts'] that account_groups was derived from
 
 def is_staff(member):
   return any(member.get_role(i) is not None for i in config['staff_roles'])
@@ -35,10 +51,151 @@ def check_staff(action=None): # "… uprawnień do {action}, …"
       raise NotStaffError(action)
   return pred
 
-async def setup(bot):
+def root_of(account):
+  parents = database.data.get('linked_accounts', {})
+  root = account
+  while root in parents:
+    root = parents[root]
+  while account != root:
+    parent = parents[account]
+    if parent != root:
+      parents[account] = root
+      database.touch('linked_accounts', account)
+    account = parent
+  return root
+
+def groups():
+  global account_groups, account_groups_source
+  parents = database.data.setdefault('linked_accounts', {})
+  if account_groups_source is not parents:
+    account_groups = {}
+    account_groups_source = parents
+    for account in list(parents):
+      account_groups.setdefault(root_of(account), {root_of(account)}).add(account)
+  return account_groups
+
+def accounts_of(account):
+  return groups().get(root_of(account), {account})
+
+def link_accounts(account1, account2):
+  # Returns whether they weren't linked before.
+  root1, root2 = root_of(account1), root_of(account2)
+  if root1 == root2:
+    return False
+  group1, group2 = accounts_of(root1), accounts_of(root2)
+  if len(group1) < len(group2):
+    root1, root2, group1, group2 = root2, root1, group2, group1
+  database.data['linked_accounts'][root2] = root1
+  database.touch('linked_accounts', root2)
+  account_groups[root1] = group1 | group2
+  account_groups.pop(root2, None)
+  return True
+
+def unlink_account(account):
+  # Returns whether it was linked to anything before.
+  root = root_of(account)
+  group = accounts_of(root)
+  if len(group) <= 1:
+    return False
+  parents = database.data['linked_accounts']
+  rest = sorted(group - {account})
+  for i in group:
+    parents.pop(i, None)
+  for i in rest[1:]:
+    parents[i] = rest[0]
+  for i in group:
+    database.touch('linked_accounts', i)
+  account_groups.pop(root)
+  account_groups[rest[0]] = set(rest)
+  return True
+
+def migrate_linked_users():
+  # Linked accounts used to be stored as a list of all the other accounts of
+  # every account.
+  if 'linked_users' in database.data:
+    logging.info('Migrating linked users to linked accounts')
+    for account, others in database.data['linked_users'].items():
+      for other in others:
+        link_accounts(account, other)
+    del database.data['linked_users']
+
+def delete_soon(msg):
+  # Deleting a message costs a request, but deleting up to 100 in bulk costs
+  # only one too, so the messages are gathered for a moment first.
+  queue = deletion_queues.get(msg.channel.id)
+  if queue is None:
+    queue = deletion_queues[msg.channel.id] = []
+    asyncio.create_task(log_exceptions(flush_deletions)(msg.channel))
+  queue.append(msg)
+
+async def flush_deletions(channel):
+  await asyncio.sleep(parse_duration(config['bulk_delete_delay']))
+  msgs = list({i.id: i for i in deletion_queues.pop(channel.id)}.values())
+
+  # Discord refuses to bulk delete messages older than 14 days.
+  limit = discord.utils.utcnow() - timedelta(days=14) + timedelta(minutes=1)
+  recent = [i for i in msgs if i.created_at > limit]
+  for i in range(0, len(recent), 100):
+    try:
+      await channel.delete_messages(recent[i:i + 100])
+    except discord.NotFound: # Only raised for a single message
+      pass
+  for msg in msgs:
+    if msg.created_at <= limit:
+      try:
+        await msg.delete()
+      except discord.NotFound:
+        pass
+
+async def fetch_users(ids):
+  # Users seen on the gateway are already cached by discord.py. The rest are
+  # kept for a while in user_cache and only the ones missing from both are
+  # fetched, all at once.
+  now = time.monotonic()
+  ttl = parse_duration(config['user_cache_ttl'])
+  result = {}
+  misses = []
+  for id in dict.fromkeys(ids):
+    if (user := bot.get_user(id)) is not None:
+      user_cache_stats['gateway'] += 1
+      result[id] = user
+    elif id in user_cache and now - user_cache[id][1] < ttl:
+      user_cache_stats['hits'] += 1
+      user_cache.move_to_end(id)
+      result[id] = user_cache[id][0]
+    else:
+      user_cache_stats['misses'] += 1
+      misses.append(id)
+
+  for id, user in zip(misses, await asyncio.gather(*map(bot.fetch_user, misses))):
+    user_cache[id] = (user, now)
+    user_cache.move_to_end(id)
+    result[id] = user
+  while len(user_cache) > config['user_cache_size']:
+    user_cache.popitem(last=False)
+  return result
+
+async def fetch_user(id):
+  return (await fetch_users([id]))[id]
+
+def describe_user_cache():
+  return f'{len(user_cache)} users cached, {user_cache_stats["gateway"]} found on the gateway, {user_cache_stats["hits"]} hits, {user_cache_stats["misses"]} misses'
+
+async def setup(_bot):
+  global bot
+  bot = _bot
+
+  # The console can restart the bot in a new event loop, which doesn't run the
+  # flush_deletions tasks of the previous one.
+  deletion_queues.clear()
+
   @bot.on_check_failure
   async def on_check_failure(interaction, error):
     if isinstance(error, NotStaffError):
       await interaction.response.send_message(f'Nie masz uprawnień do {error.action}, tylko administracja może to robić. 😡', ephemeral=True)
     else:
       raise
+
+console.begin('utils')
+console.register('user_cache', None, 'shows the statistics of the user cache', describe_user_cache)
+console.end()
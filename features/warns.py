@@ -14,31 +14,86 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import discord, logging, random
+import asyncio, discord, logging, random
 from dataclasses import dataclass
+from bisect import bisect_left, insort
 from datetime import datetime
+from heapq import heappop, heappush
 from dateutil.relativedelta import relativedelta
 from zoneinfo import ZoneInfo
 
 import console, database
-from common import config, debacktick, format_datetime, limit_len, mention_date, mention_datetime, pages_view, select_view
-from features.utils import check_staff, is_staff
+from common import config, debacktick, format_datetime, limit_len, log_exceptions, mention_date, mention_datetime, pages_view, select_view
+from features.utils import accounts_of, check_staff, is_staff, root_of
 
 warn_expiration_is_enabled = True
 
 bot = None
 
-def warns_of(user):
-  return [warn for account in database.data.get('linked_users', {}).get(user, []) + [user] for warn in database.data.get('warns', {}).get(account, [])]
+# The next expire of every account with warns. Until the warns of its group
+# change, do_expires has nothing to do before that time, so it's enough to
+# run it when one of these comes due.
+next_expires = {}
+expire_heap = [] # (time, account), including outdated entries not matching next_expires
+expire_interval = None # The config['warn_expire_interval'] that next_expires was computed for
+expire_wakeup = None # Created in setup, as an Event belongs to the loop it was first used in
+
+group_warns = {} # Root account -> warns of its group sorted by time, invalidated by schedule_expires
+all_warns = None # (warn, account) of all warns on the server sorted by time, see all_warns_of
+warns_source = None # The database.data['warns'] that everything above was computed for
+
+def check_source():
+  # Everything derived from the warns refers to their objects, so it's all
+  # recomputed once database.data['warns'] gets replaced, e.g. by a restore.
+  if warns_source is not database.data.get('warns'):
+    do_expires_all()
+
+def read_group_warns(user):
+  return sorted((warn for account in accounts_of(user) for warn in database.data.get('warns', {}).get(account, [])), key=lambda x: x['time'])
+
+def warns_of(user): # Don't modify the returned list.
+  check_source()
+  root = root_of(user)
+  if root not in group_warns:
+    group_warns[root] = read_group_warns(root)
+  return group_warns[root]
+
+def all_warns_of():
+  global all_warns
+  check_source()
+  if all_warns is None:
+    all_warns = sorted(((warn, account) for account, warns in database.data.get('warns', {}).items() for warn in warns), key=lambda x: x[0]['time'])
+  return all_warns
+
+def add_to_all_warns(warn, account):
+  check_source()
+  if all_warns is not None:
+    insort(all_warns, (warn, account), key=lambda x: x[0]['time'])
+
+def remove_from_all_warns(warn, account):
+  global all_warns
+  check_source()
+  if all_warns is not None:
+    # The warn doesn't have to be the object in all_warns, so it's looked for by
+    # its contents among the warns from the same time.
+    i = bisect_left(all_warns, warn['time'], key=lambda x: x[0]['time'])
+    while i < len(all_warns) and all_warns[i][0]['time'] == warn['time']:
+      if all_warns[i][1] == account and all_warns[i][0]['reason'] == warn['reason']:
+        del all_warns[i]
+        return
+      i += 1
+    all_warns = None # Out of sync, so it gets rebuilt on next use.
 
 def do_expires(user): # Restarting this algorithm at any point during its execution is corruption-free, so we don't need to acquire database.lock.
+  # Returns the time of the next expire, if there is going to be one.
   if not warn_expiration_is_enabled:
-    return
+    return None
 
-  warns = warns_of(user)
-  warns.sort(key=lambda x: x['time'])
+  # The expires are applied to the warns as they are in the database right
+  # now, so that they get saved.
+  warns = read_group_warns(user)
   if not warns:
-    return
+    return None
 
   barriers = []
   for warn in warns:
@@ -52,6 +107,8 @@ def do_expires(user): # Restarting this algorithm at any point during its execut
 
   time = datetime.fromtimestamp(0).astimezone()
   i = 0
+  is_changed = False
+  next_expire = None
   for warn in warns:
     if warn['expired']:
       continue
@@ -63,18 +120,75 @@ def do_expires(user): # Restarting this algorithm at any point during its execut
       i += 1
     time += interval
     if time > now:
+      next_expire = time
       break
     warn['expired'] = time
-  database.should_save = True
+    is_changed = True
+
+  if is_changed:
+    for account in accounts_of(user):
+      database.touch('warns', account)
+  return next_expire
+
+def schedule_expires(user):
+  # Must be called after every change to the warns of the user or to the
+  # accounts linked to them.
+  check_source()
+  group_warns.pop(root_of(user), None)
+  time = do_expires(user)
+  for account in accounts_of(user):
+    if time is None:
+      next_expires.pop(account, None)
+    elif next_expires.get(account) != time:
+      next_expires[account] = time
+      heappush(expire_heap, (time, account))
+  expire_wakeup.set()
+
+def do_due_expires():
+  if expire_interval != config['warn_expire_interval'] or warns_source is not database.data.get('warns'):
+    do_expires_all()
+    return
+  now = datetime.now().astimezone()
+  while expire_heap and expire_heap[0][0] <= now:
+    time, account = heappop(expire_heap)
+    if next_expires.get(account) == time:
+      schedule_expires(account)
 
 def do_expires_all():
+  global expire_interval
+  expire_interval = config['warn_expire_interval']
+  global warns_source
+  warns_source = database.data.get('warns')
+  global all_warns
+  next_expires.clear()
+  expire_heap.clear()
+  group_warns.clear()
+  all_warns = None
   for user in database.data.get('warns', {}):
-    do_expires(user)
+    schedule_expires(user)
+
+async def expire_timer():
+  while True:
+    while expire_heap and next_expires.get(expire_heap[0][1]) != expire_heap[0][0]:
+      heappop(expire_heap)
+    timeout = (expire_heap[0][0] - datetime.now().astimezone()).total_seconds() if expire_heap else None
+    try:
+      await asyncio.wait_for(expire_wakeup.wait(), timeout)
+    except asyncio.TimeoutError:
+      pass
+    expire_wakeup.clear()
+    do_due_expires()
 
 async def setup(_bot):
   global bot
   bot = _bot
 
+  # The console can restart the bot in a new event loop.
+  global expire_wakeup
+  expire_wakeup = asyncio.Event()
+  do_expires_all()
+  asyncio.create_task(log_exceptions(expire_timer)())
+
   async def warn(interaction, user, reason):
     logging.info(f'Adding warn for {user.id} with reason {reason!r}')
     warn = {
@@ -84,9 +198,10 @@ async def setup(_bot):
     }
     database.data.setdefault('warns', {}).setdefault(user.id, []).append(warn)
     database.data['warns'][user.id].sort(key=lambda x: x['time'])
-    database.should_save = True
+    database.touch('warns', user.id)
+    add_to_all_warns(warn, user.id)
 
-    do_expires(user.id)
+    schedule_expires(user.id)
     count = sum(not warn['expired'] for warn in warns_of(user.id))
     await interaction.response.send_message(f'{user.mention} właśnie dostał swoje **{count}-e** ostrzeżenie za `{debacktick(reason)}`! 😒', allowed_mentions=discord.AllowedMentions.all())
 
@@ -110,19 +225,25 @@ async def setup(_bot):
     await interaction.response.send_modal(modal)
 
   async def erase_warn(interaction, user):
-    if (user == interaction.user or user.id in database.data.get('linked_users', {}).get(interaction.user.id, [])) and interaction.user != interaction.guild.owner:
+    if root_of(user.id) == root_of(interaction.user.id) and interaction.user != interaction.guild.owner:
       await interaction.response.send_message('Nie możesz usuwać sobie ostrzeżeń. 😒', ephemeral=True)
       return
     elif not database.data.get('warns', {}).get(user.id, []):
       await interaction.response.send_message(f'Na koncie {user.mention} nie ma żadnych ostrzeżeń, które możesz usunąć… 🤨', ephemeral=True)
       return
 
+    # The options refer to the warns by their IDs, so the warns must be kept
+    # alive, as the database may drop objects nothing else refers to.
+    warns = list(reversed(database.data['warns'][user.id]))
+
     async def callback(interaction2, choice):
-      warn = next(i for i in database.data['warns'][user.id] if id(i) == int(choice))
+      warn = next(i for i in warns if id(i) == int(choice))
 
       logging.info(f'Erasing warn for {user.id} with reason {warn["reason"]!r} from {warn["time"]}')
       database.data['warns'][user.id].remove(warn)
-      database.should_save = True
+      database.touch('warns', user.id)
+      remove_from_all_warns(warn, user.id)
+      schedule_expires(user.id)
 
       reason = debacktick(warn['reason'])
       time = mention_datetime(warn['time'])
@@ -136,7 +257,7 @@ async def setup(_bot):
           value=id(warn),
           description=format_datetime(warn['time']),
         )
-        for warn in reversed(database.data['warns'][user.id])
+        for warn in warns
       ],
       callback,
       interaction.user,
@@ -155,15 +276,18 @@ async def setup(_bot):
     await erase_warn(interaction, user)
 
   async def edit_warn(interaction, user):
-    if (user == interaction.user or user.id in database.data.get('linked_users', {}).get(interaction.user.id, [])) and interaction.user != interaction.guild.owner:
+    if root_of(user.id) == root_of(interaction.user.id) and interaction.user != interaction.guild.owner:
       await interaction.response.send_message('Nie możesz edytować sobie ostrzeżeń. 😒', ephemeral=True)
       return
     elif not database.data.get('warns', {}).get(user.id, []):
       await interaction.response.send_message(f'Na koncie {user.mention} nie ma żadnych ostrzeżeń… 🤨', ephemeral=True)
       return
 
+    # See erase_warn.
+    warns = list(reversed(database.data['warns'][user.id]))
+
     async def show_modal(interaction2, choice):
-      warn = next(i for i in database.data['warns'][user.id] if id(i) == int(choice))
+      warn = next(i for i in warns if id(i) == int(choice))
 
       async def on_submit(interaction3):
         try:
@@ -199,7 +323,8 @@ async def setup(_bot):
           logging.info(f'Edited warn for {user.id} with reason {warn["reason"]!r} from {warn["time"]}')
           warn['reason'] = new_reason
           warn['expired'] = new_expired
-          database.should_save = True
+          database.touch('warns', user.id)
+          schedule_expires(user.id)
 
           msg = 'Pomyślnie '
           if old_reason == new_reason and old_expired == new_expired:
@@ -234,7 +359,7 @@ async def setup(_bot):
           value=id(warn),
           description=format_datetime(warn['time']),
         )
-        for warn in reversed(database.data['warns'][user.id])
+        for warn in warns
       ],
       show_modal,
       interaction.user,
@@ -253,9 +378,9 @@ async def setup(_bot):
     await edit_warn(interaction, user)
 
   async def warns(interaction, user, should_be_verbose=False):
-    do_expires(user.id)
+    do_due_expires()
     active, expired = [], []
-    for account in database.data.get('linked_users', {}).get(user.id, []) + [user.id]:
+    for account in accounts_of(user.id):
       for warn in database.data.get('warns', {}).get(account, []):
         if warn['expired']:
           expired.append((warn, account))
@@ -295,11 +420,7 @@ async def setup(_bot):
     if not active and not (expired and is_staff(interaction.user)):
       append(f'{user.mention} jest grzeczny jak aniołek i nie nazbierał jeszcze żadnych ostrzeżeń! 😇')
 
-    async def on_select_page(interaction2, page):
-      await interaction2.response.defer()
-      await interaction2.edit_original_response(content=pages[page], view=view)
-    view = pages_view(0, len(pages), on_select_page, interaction.user)
-
+    view = pages_view(0, len(pages), None, interaction.user, contents_of=lambda page: pages[page])
     await interaction.response.send_message(pages[0], view=view, ephemeral=True)
 
   @bot.tree.command(name='warns', description='Pokazuje ostrzeżenia użytkownika')
@@ -314,38 +435,28 @@ async def setup(_bot):
   @bot.tree.command(name='warns-all', description='Pokazuje całą historię ostrzeżeń')
   @check_staff('przeglądania historii ostrzeżeń')
   async def warns_all(interaction):
-    do_expires_all()
-    all_warns = []
-    for account, warns in database.data.get('warns', {}).items():
-      all_warns += [(i, account) for i in warns]
-    all_warns.sort(key=lambda x: x[0]['time'])
-
-    pages = ['']
-    def append(line):
-      if len(pages[-1]) + len(line) > 2000:
-        pages.append('')
-      pages[-1] += line
-
-    if not warn_expiration_is_enabled:
-      append('## Wygaszanie ostrzeżeń jest wyłączone! ⚠️\n')
-
-    if all_warns:
-      append('Historia wszystkich ostrzeżeń na serwerze: 📜\n')
-      for warn, account in reversed(all_warns):
-        reason = debacktick(warn['reason'])
+    do_due_expires()
+    all_warns = all_warns_of()
+
+    # Reasons are shortened, so that 10 warns always fit in a message.
+    def contents_of(page):
+      result = ''
+      if not warn_expiration_is_enabled:
+        result += '## Wygaszanie ostrzeżeń jest wyłączone! ⚠️\n'
+      if not all_warns:
+        return result + 'Wszyscy są grzeczni jak aniołki i nikt nie nazbierał jeszcze żadnych ostrzeżeń! 😇'
+
+      result += 'Historia wszystkich ostrzeżeń na serwerze: 📜\n'
+      for i in range(len(all_warns) - 1 - 10 * page, max(len(all_warns) - 1 - 10 * (page + 1), -1), -1):
+        warn, account = all_warns[i]
+        reason = debacktick(limit_len(warn['reason']))
         time = mention_datetime(warn['time'])
         expired = '' if warn['expired'] is None else f' wygasłe {mention_date(warn["expired"])}'
-        append(f'- w dniu {time} dla <@{account}> za `{reason}` {expired}\n')
+        result += f'- w dniu {time} dla <@{account}> za `{reason}` {expired}\n'
+      return result
 
-    else:
-      append('Wszyscy są grzeczni jak aniołki i nikt nie nazbierał jeszcze żadnych ostrzeżeń! 😇')
-
-    async def on_select_page(interaction2, page):
-      await interaction2.response.defer()
-      await interaction2.edit_original_response(content=pages[page], view=view)
-    view = pages_view(0, len(pages), on_select_page, interaction.user)
-
-    await interaction.response.send_message(pages[0], view=view, ephemeral=True)
+    view = pages_view(0, (len(all_warns) + 10 - 1) // 10, None, interaction.user, contents_of=contents_of)
+    await interaction.response.send_message(contents_of(0), view=view, ephemeral=True)
 
   @bot.tree.command(name='toggle-warn-expiration', description='Włącza lub wyłącza wygaszanie ostrzeżeń')
   @check_staff('włączania lub wyłączania wygaszania ostrzeżeń')
@@ -353,8 +464,9 @@ async def setup(_bot):
     global warn_expiration_is_enabled
     warn_expiration_is_enabled = not warn_expiration_is_enabled
     logging.info(f'{interaction.user.id} {"enabled" if warn_expiration_is_enabled else "disabled"} warn expiration')
+    do_expires_all()
     await interaction.response.send_message(f'Pomyślnie {"włączono" if warn_expiration_is_enabled else "wyłączono"} wygaszanie ostrzeżeń. 🫡', ephemeral=True)
 
 console.begin('warns')
-console.register('do_expires_all', None, 'applies any pending expires', do_expires_all)
+console.register('do_expires_all', None, 'applies any pending expires and reschedules all future ones', lambda: bot.loop.call_soon_threadsafe(do_expires_all))
 console.end()
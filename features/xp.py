@@ -14,23 +14,26 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import asyncio, discord, logging, random
-from datetime import datetime
+import asyncio, discord, logging, random, time
 from math import floor, sqrt
 from threading import Lock
 
 import console, database
-from common import config, hybrid_check, pages_view, parse_duration
+from common import config, hybrid_check, loop, pages_view, parse_duration
 
 bot = None
 lock = Lock()
+pending = [] # Messages waiting for the next flush() as (member, time)
+
+database.schemas['xp'] = database.keyed_by_int()
+database.schemas['xp_last_gain'] = database.keyed_by_int(database.as_datetime)
 
 def get_xp(self):
   return database.data.get('xp', {}).get(self.id, 0)
 
 def set_xp(self, value):
   database.data.setdefault('xp', {})[self.id] = value
-  database.should_save = True
+  database.touch('xp', self.id)
 
 discord.User.xp = discord.Member.xp = property(get_xp, set_xp)
 
@@ -41,16 +44,48 @@ def level_to_xp(level):
   return level * (level + 1) // 2 * 100
 
 async def update_roles_for(member):
-  logging.info(f'Updating XP roles for {member.id}')
+  # Returns whether any roles had to be changed. Only the roles that differ
+  # from the cached ones cost a request.
   assert member.guild.id == config['guild']
   level = xp_to_level(member.xp)
-  await member.remove_roles(*(discord.Object(role) for threshold, role in config['xp_roles'] if level < threshold), atomic=False)
-  await member.add_roles(*(discord.Object(role) for threshold, role in config['xp_roles'] if level >= threshold), atomic=False)
+  current = {role.id for role in member.roles}
+  to_remove = [discord.Object(role) for threshold, role in config['xp_roles'] if level < threshold and role in current]
+  to_add = [discord.Object(role) for threshold, role in config['xp_roles'] if level >= threshold and role not in current]
+  if not to_remove and not to_add:
+    return False
+  logging.info(f'Updating XP roles for {member.id}')
+  await member.remove_roles(*to_remove, atomic=False)
+  await member.add_roles(*to_add, atomic=False)
+  return True
 
 async def update_roles():
-  logging.info('Updating XP roles for all members')
-  for member in bot.get_guild(config['guild']).members:
-    await update_roles_for(member)
+  members = bot.get_guild(config['guild']).members
+  logging.info(f'Updating XP roles for all {len(members)} members')
+
+  # A few workers share one iterator over the members. discord.py already
+  # waits out the rate limit buckets of the requests, so the worker count only
+  # caps how many requests are in flight at once.
+  queue = iter(members)
+  checked = updated = failed = 0
+  start = time.monotonic()
+  last_report = start
+  async def worker():
+    nonlocal checked, updated, failed, last_report
+    for member in queue:
+      try:
+        updated += await update_roles_for(member)
+      except discord.HTTPException:
+        logging.exception(f'Got exception while updating XP roles for {member.id}')
+        failed += 1
+      checked += 1
+      if time.monotonic() - last_report >= 10:
+        last_report = time.monotonic()
+        logging.info(f'Checked XP roles for {checked}/{len(members)} members, updated {updated} ({checked / (last_report - start):.1f} members/s)')
+  await asyncio.gather(*(worker() for _ in range(config['xp_role_workers'])))
+
+  result = f'Updated XP roles for {updated} out of {checked} members in {time.monotonic() - start:.1f}s, {failed} failed'
+  logging.info(result)
+  return result
 
 class NoXpRolesError(discord.app_commands.CheckFailure):
   pass
@@ -76,34 +111,53 @@ async def setup(_bot):
     member = msg.author
     if member.bot or msg.is_system() or msg.guild is None or msg.guild.id != config['guild'] or (msg.channel.id not in config['xp_unignored_channels'] and (msg.channel.id in config['xp_ignored_channels'] or msg.channel.category_id in config['xp_ignored_categories'])):
       return
+    pending.append((member, msg.created_at))
+
+  # Messages are only queued up by on_message and get turned into XP here in
+  # bulk, which takes the lock once per batch instead of twice per message.
+  @loop(interval=config['xp_flush_rate'])
+  async def flush():
+    global pending
+    batch, pending = pending, []
+    if not batch:
+      return
 
+    level_ups = {}
     with lock:
-      now = datetime.now().astimezone()
-      if member.id in database.data.setdefault('xp_last_gain', {}):
-        cooldown = parse_duration(config['xp_cooldown'])
-        if (now - database.data['xp_last_gain'][member.id]).total_seconds() < cooldown:
-          return
-      database.data['xp_last_gain'][member.id] = now
-
-    gain = random.randint(config['xp_min_gain'], config['xp_max_gain'])
-    logging.info(f'{member.id} gained {gain} XP')
-    with lock:
-      old_level = xp_to_level(member.xp)
-      member.xp += gain
-      level = xp_to_level(member.xp)
-
-    if level != old_level:
-      await update_roles_for(member)
-
-      if config['xp_channel'] is not None:
-        emoji = random.choice(['🥳', '🎉', '🎊'])
-        announcement = random.choice([
-          f'{member.mention} nie ma życia i dzięki temu jest już na poziomie **{level}**! {emoji}',
-          f'{member.mention} właśnie wszedł na wyższy poziom **{level}**! {emoji}',
-          f'{member.mention} zdobył kolejny poziom **{level}**. Brawo! {emoji}',
-          f'{member.mention} zdobył kolejny poziom **{level}**. Moje kondolencje. {emoji}',
-        ])
-        await bot.get_channel(config['xp_channel']).send(announcement, allowed_mentions=discord.AllowedMentions.all())
+      cooldown = parse_duration(config['xp_cooldown'])
+      last_gain = database.data.setdefault('xp_last_gain', {})
+      for member, created_at in batch:
+        if member.id in last_gain and (created_at - last_gain[member.id]).total_seconds() < cooldown:
+          continue
+        last_gain[member.id] = created_at
+        database.touch('xp_last_gain', member.id)
+
+        gain = random.randint(config['xp_min_gain'], config['xp_max_gain'])
+        logging.info(f'{member.id} gained {gain} XP')
+        old_level = xp_to_level(member.xp)
+        member.xp += gain
+        level = xp_to_level(member.xp)
+        if level != old_level:
+          level_ups[member] = level
+
+    for member, level in level_ups.items():
+      # One member failing mustn't lose the level ups of the rest of the batch.
+      try:
+        await update_roles_for(member)
+
+        if config['xp_channel'] is not None:
+          emoji = random.choice(['🥳', '🎉', '🎊'])
+          announcement = random.choice([
+            f'{member.mention} nie ma życia i dzięki temu jest już na poziomie **{level}**! {emoji}',
+            f'{member.mention} właśnie wszedł na wyższy poziom **{level}**! {emoji}',
+            f'{member.mention} zdobył kolejny poziom **{level}**. Brawo! {emoji}',
+            f'{member.mention} zdobył kolejny poziom **{level}**. Moje kondolencje. {emoji}',
+          ])
+          await bot.get_channel(config['xp_channel']).send(announcement, allowed_mentions=discord.AllowedMentions.all())
+      except Exception:
+        logging.exception(f'Got exception while announcing level up of {member.id}')
+
+  flush.start()
 
   xp = discord.app_commands.Group(name='xp', description='Komendy do XP')
   bot.tree.add_command(xp)
@@ -113,28 +167,23 @@ async def setup(_bot):
       await interaction.response.send_message(f'{marked_user.mention} jest botem i nie może zbierać XP… 😐', ephemeral=True)
       return
 
-    ranking = sorted(database.data['xp'].items(), key=lambda x: x[1], reverse=True)
     def contents_of(page):
       result = 'Ranking użytkowników według XP: 🏆\n'
-      for i in range(20 * page, 20 * (page + 1)):
-        try:
-          user, xp = ranking[i]
-        except IndexError:
-          break
+      for i, (user, xp) in enumerate(database.ranking('xp', 20 * page, 20 * (page + 1)), 20 * page):
         level = xp_to_level(xp)
         left = level_to_xp(level + 1) - xp
         result += f'{i + 1}. <@{user}> z **{xp} XP** i poziomem **{level}** - do następnego **{left} XP**' + (' **⬅️**\n' if user == marked_user.id else '\n')
       return result
 
-    try:
-      init_page = next(i for i, entry in enumerate(ranking) if entry[0] == marked_user.id) // 20
-    except StopIteration:
+    rank = database.rank_of('xp', marked_user.id)
+    if rank is None:
       await interaction.response.send_message(f'{marked_user.mention} nie zebrał jeszcze żadnego XP. 😴', ephemeral=True)
       return
+    init_page = rank // 20
     async def on_select_page(interaction2, page):
       await interaction2.response.defer()
       await interaction2.edit_original_response(content=contents_of(page), view=view)
-    view = pages_view(init_page, (len(ranking) + 20 - 1) // 20, on_select_page, interaction.user)
+    view = pages_view(init_page, (len(database.data['xp']) + 20 - 1) // 20, on_select_page, interaction.user)
 
     await interaction.response.send_message(contents_of(init_page), view=view, ephemeral=True)
 
@@ -158,7 +207,8 @@ async def transfer(from_, to):
   with lock:
     database.data['xp'][to] += database.data['xp'][from_]
     database.data['xp'][from_] = 0
-    database.should_save = True
+    database.touch('xp', to)
+    database.touch('xp', from_)
 
   if (member := bot.get_guild(config['guild']).get_member(from_)) is not None:
     await update_roles_for(member)
@@ -168,7 +218,7 @@ async def transfer(from_, to):
 def init(user):
   with lock:
     database.data.setdefault('xp', {}).setdefault(user, 0)
-    database.should_save = True
+    database.touch('xp', user)
 
 console.begin('xp')
 console.register('update_roles', None, 'updates XP roles for all members', lambda: asyncio.run_coroutine_threadsafe(update_roles(), bot.loop).result())
@@ -0,0 +1,88 @@
+# OOOZet - Bot społeczności OOOZ
+# Copyright (C) 2023-2026 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os, tempfile, unittest
+
+import database
+from common import config
+
+class DatabaseTest(unittest.TestCase):
+  backend = 'json'
+
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.old_config = config.copy()
+    config['database'] = os.path.join(self.dir.name, 'database.json')
+    config['database_backend'] = self.backend
+    database.load()
+
+  def tearDown(self):
+    if database.connection is not None:
+      database.connection.close()
+      database.connection = None
+    config.clear()
+    config.update(self.old_config)
+    self.dir.cleanup()
+
+class SqliteTableTest(DatabaseTest):
+  backend = 'sqlite'
+
+  def test_value_held_across_saves_is_written_back(self):
+    database.data['warns'] = {1: [{'time': 1, 'reason': 'a', 'expired': None}], 2: [{'time': 2, 'reason': 'b', 'expired': None}]}
+    database.touch('warns')
+    database.save()
+
+    warns = database.data['warns'][1]
+    warn = database.data['warns'][2][0]
+    for _ in range(3):
+      database.save()
+    self.assertIs(database.data['warns'][1], warns)
+
+    warns[0]['expired'] = 5
+    database.touch('warns', 1)
+    warn['expired'] = 6
+    database.touch('warns', 2)
+    database.save()
+
+    database.load()
+    self.assertEqual(database.data['warns'][1], [{'time': 1, 'reason': 'a', 'expired': 5}])
+    self.assertEqual(database.data['warns'][2], [{'time': 2, 'reason': 'b', 'expired': 6}])
+
+  def test_unused_values_are_dropped(self):
+    database.data['warns'] = {i: [{'time': i}] for i in range(10)}
+    database.touch('warns')
+    database.save()
+
+    values = database.data['warns'].values()
+    database.save()
+    self.assertEqual(len(database.data['warns'].cache), 10)
+
+    del values
+    database.save()
+    self.assertEqual(len(database.data['warns'].cache), 0)
+    self.assertEqual(database.data['warns'][3], [{'time': 3}])
+
+  def test_unsaved_section_replacement_is_rolled_back(self):
+    database.data['warns'] = {1: [{'time': 1}]}
+    database.touch('warns')
+    database.save()
+
+    database.data['warns'] = {2: [{'time': 2}]}
+    database.load()
+    self.assertEqual(dict(database.data['warns'].items()), {1: [{'time': 1}]})
+
+if __name__ == '__main__':
+  unittest.main()
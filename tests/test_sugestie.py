@@ -0,0 +1,85 @@
+# OOOZet - Bot społeczności OOOZ
+# Copyright (C) 2023-2026 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio, os, unittest
+from datetime import datetime
+
+import database
+from features import sugestie
+from test_database import DatabaseTest
+
+def make_sugestia(id, **kwargs):
+  now = datetime.now().astimezone()
+  return {
+    'id': id,
+    'channel': 1,
+    'text': 'x',
+    'image': None,
+    'time': now,
+    'author': 1,
+    'opinions': {},
+    'review_end': now,
+    'for': set(),
+    'abstain': set(),
+    'against': set(),
+    'vote_end': now,
+  } | kwargs
+
+class BlobTest(DatabaseTest):
+  def test_erasing_deletes_unused_image(self):
+    shared = database.put_blob(b'shared')
+    own = database.put_blob(b'own')
+    a = make_sugestia(1, image={'blob': shared, 'format': 'image/png'})
+    b = make_sugestia(2, image={'blob': shared, 'format': 'image/png'})
+    c = make_sugestia(3, image={'blob': own, 'format': 'image/png'})
+    for sugestia in [a, b, c]:
+      sugestie.add(sugestia)
+
+    for sugestia in [a, c]:
+      sugestie.remove(sugestia)
+      asyncio.run(sugestie.forget_image(sugestia['image']))
+
+    self.assertTrue(os.path.exists(database.blob_path(shared)))
+    self.assertFalse(os.path.exists(database.blob_path(own)))
+
+class ArchiveTest(DatabaseTest):
+  def test_rejected_sugestia_is_archived_and_annullable(self):
+    sugestia = make_sugestia(1)
+    sugestie.add(sugestia)
+    sugestia['outcome'] = False
+    sugestie.touch(sugestia)
+
+    self.assertEqual(sugestie.hot(), [])
+    self.assertIs(sugestie.get(1), sugestia)
+    self.assertEqual(sugestie.annullable_sugestie(), [sugestia])
+
+    sugestia['annulled'] = {'time': datetime.now().astimezone(), 'reason': 'x'}
+    sugestie.touch(sugestia)
+    self.assertEqual(sugestie.annullable_sugestie(), [])
+
+    database.save()
+    database.load()
+    self.assertIn('annulled', sugestie.get(1))
+    self.assertEqual(database.data['sugestie_rejected'], [])
+
+  def test_migration_archives_rejected_sugestie(self):
+    database.data['sugestie'] = [make_sugestia(1, outcome=False), make_sugestia(2, outcome=True), make_sugestia(3)]
+    sugestie.migrate_archive()
+    self.assertEqual([i['id'] for i in sugestie.hot()], [2, 3])
+    self.assertEqual([i['id'] for i in sugestie.annullable_sugestie()], [1, 2, 3])
+
+if __name__ == '__main__':
+  unittest.main()
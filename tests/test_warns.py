@@ -0,0 +1,71 @@
+# OOOZet - Bot społeczności OOOZ
+# Copyright (C) 2023-2026 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio, unittest
+from datetime import datetime, timedelta
+
+import database
+from common import config
+from features import warns
+from test_database import DatabaseTest
+
+def make_warn(days_ago):
+  return {'time': datetime.now().astimezone() - timedelta(days=days_ago), 'reason': 'x', 'expired': None}
+
+class WarnsTest(DatabaseTest):
+  def setUp(self):
+    super().setUp()
+    config['warn_expire_interval'] = {'days': 90}
+    warns.expire_wakeup = asyncio.Event()
+
+class ExpireTest(WarnsTest):
+  def test_expires_apply_to_reloaded_warns(self):
+    database.data['warns'] = {1: [make_warn(100)]}
+    database.touch('warns')
+    database.save()
+    database.data['warns'] = {2: [make_warn(1)]}
+    warns.do_expires_all()
+
+    database.load() # Like a restore from a backup
+    warns.do_due_expires()
+    self.assertEqual([account for _, account in warns.all_warns_of()], [1])
+    self.assertIsNotNone(database.data['warns'][1][0]['expired'])
+
+    database.save()
+    database.load()
+    self.assertIsNotNone(database.data['warns'][1][0]['expired'])
+
+class AllWarnsTest(WarnsTest):
+  def test_remove_matches_by_contents(self):
+    a, b = make_warn(2), make_warn(1)
+    database.data['warns'] = {1: [a], 2: [b]}
+    warns.all_warns_of()
+    warns.remove_from_all_warns(b.copy(), 2)
+    self.assertEqual(warns.all_warns_of(), [(a, 1)])
+
+  def test_remove_rebuilds_when_missing(self):
+    a, b = make_warn(2), make_warn(1)
+    database.data['warns'] = {1: [a], 2: [b]}
+    warns.all_warns_of()
+    database.data['warns'][2].remove(b)
+    warns.remove_from_all_warns(b | {'reason': 'y'}, 2)
+    self.assertEqual(warns.all_warns_of(), [(a, 1)])
+
+class SqliteExpireTest(ExpireTest):
+  backend = 'sqlite'
+
+if __name__ == '__main__':
+  unittest.main()